@@ -118,6 +118,7 @@ RMSfactor    = 0.5            # continuum rms level (not noise from emission-fre
 cube_rms     = 3.             # cube noise (true noise) x this factor
 cont_chans   = '2~5'          # line free channels for cube rms estimation
 sdmasklev    = 0.3            # maximum x this factor = threshold for SD mask
+maskmethod   = 'casa'         # 'casa' or 'numpy'
 				              
 
 #### SD-INT-AM masks for all methods using tclean etc (steps 2, 5 - 7)
@@ -129,6 +130,16 @@ sdint_SDAMmask  = 'INT'
 TP2VIS_SDAMmask = 'INT' 
 
 
+### FEATHER options (step 3)
+
+feathermethod = 'casa'        # 'casa', 'numpy' or 'check'
+
+
+### SSC options (step 4)
+
+sscmethod     = 'casa'        # 'casa', 'numpy' or 'check'
+
+
 ### SDINT options (step 6)
 
 sdpsf   = ''
@@ -155,6 +166,7 @@ TPpointinglistAlternative = 'user-defined.ptg'
 
 TPnoiseRegion             = '150,200,150,200'  # in unregridded SD image (i.e. sdreordered = sdbase +'.SD_ro.image')
 TPnoiseChannels           = '2~5'              # in unregridded and un-cut SD cube (i.e. sdreordered = sdbase +'.SD_ro.image')!
+TPnvgrp                   = 5                  # visibility groups per pointing, or 'auto'
 
       
 ## Assessment related (step 8)
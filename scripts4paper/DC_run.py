@@ -199,6 +199,11 @@ threshmask      = imbase + '.'+mode +'_'+ specsetup+ '_RMS'       # thresold mas
 SD_mask_root    = sdbase + '.'+mode +'_'+ specsetup+ '_SD'        # SD mask name
 combined_mask   = SD_mask_root + '-RMS.mask'                      # SD+AM+threshold mask name
 
+try:                                         # optional in DC_pars
+    maskmethod
+except NameError:
+    maskmethod = 'casa'
+
 
 
 # masking mode setup
@@ -340,7 +345,8 @@ else: #if imnameth/tcleanname + '.image' exists, simply re-derive the mask etc.
                                  cube_rms   = cube_rms,    
                                  cont_chans = cont_chans,
                                  theoreticalRMS=theoreticalRMS,
-                                 makemask=True
+                                 makemask=True,
+                                 method=maskmethod
                                  )        
 
     print(' ')   
@@ -531,7 +537,8 @@ if mystep in thesteps:
                                      cube_rms   = cube_rms,    
                                      cont_chans = cont_chans,
                                      theoreticalRMS=theoreticalRMS,
-                                     makemask=True
+                                     makemask=True,
+                                     method=maskmethod
                                      )
                                       
 
@@ -594,7 +601,8 @@ if mystep in thesteps:
                                      cube_rms   = cube_rms,    
                                      cont_chans = cont_chans,
                                      theoreticalRMS=theoreticalRMS,
-                                     makemask=True
+                                     makemask=True,
+                                     method=maskmethod
                                      )
 
         print(' ')   
@@ -634,21 +642,28 @@ if mystep in thesteps:
     #intpb='/data/moser/data_combi/DC/DC_Ly_tests//pointGauss/BGauss_3L.pb_ro_reg'
     intimage = imbase + cleansetup + tcleansetup + '.image'
     intpb    = imbase + cleansetup + tcleansetup + '.pb'
+
+    try:                                         # optional in DC_pars
+        feathermethod
+    except NameError:
+        feathermethod = 'casa'
     
+    imnames = []
     for i in range(0,len(sdfac)):
         
         #imname = '/data/moser/data_combi/DC/DC_Ly_tests//pointGauss/BGauss_3L' + feathersetup + str(sdfac[i]) 
         imname = imbase + cleansetup + feathersetup + str(sdfac[i]) 
-                    
-        if dryrun == True:
-            print('Skip execution!')
-        else:
-            dc.runfeather(intimage, intpb, sdimage, sdfactor = sdfac[i],
-                          featherim = imname)
-
+        imnames.append(imname)
 
         featherims.append(imname+'.image')
 
+    # all sdfac in one pass for feathermethod='numpy'
+    if dryrun == True:
+        print('Skip execution!')
+    else:
+        dc.runfeather_sweep(intimage, intpb, sdimage, sdfactors = sdfac,
+                            featherims = imnames, method = feathermethod)
+
 
 
 
@@ -670,21 +685,29 @@ if mystep in thesteps:
     intimage = imbase + cleansetup + tcleansetup + '.image'
     intpb    = imbase + cleansetup + tcleansetup + '.pb'
 
+    try:                                         # optional in DC_pars
+        sscmethod
+    except NameError:
+        sscmethod = 'casa'
+
+    imnames = []
     for i in range(0,len(SSCfac)):
         #imname = '/data/moser/data_combi/DC/DC_Ly_tests//pointGauss/BGauss_3L'  + SSCsetup + str(SSCfac[i]) 
         imname = imbase + cleansetup + SSCsetup + str(SSCfac[i]) 
+        imnames.append(imname)
         
-        if dryrun == True:
-            print('Skip execution!')
-        else:
+        if dryrun != True:
             os.system('rm -rf '+imname+'*')
-
-            dc.ssc(highres=intimage, lowres=sdimage, pb=intpb,
-                   sdfactor = SSCfac[i], combined=imname) 
-   
                    
         SSCims.append(imname+'.image')
 
+    # all SSCfac in one pass for sscmethod='numpy'
+    if dryrun == True:
+        print('Skip execution!')
+    else:
+        dc.ssc_sweep(highres=intimage, lowres=sdimage, pb=intpb,
+                     sdfactors = SSCfac, combineds=imnames, method=sscmethod) 
+
 
 
 
@@ -788,6 +811,11 @@ if mystep in thesteps:
         imTP = sdreordered
     TPresult= imTP.replace('.image','.ms')
     imname1 = imbase + cleansetup + TP2VISsetup  # first plot
+
+    try:                                         # optional in DC_pars
+        TPnvgrp
+    except NameError:
+        TPnvgrp = 5
      
     if dryrun == True:
         pass
@@ -795,7 +823,7 @@ if mystep in thesteps:
         dc.create_TP2VIS_ms(imTP=imTP, TPresult=TPresult,
             TPpointinglist=TPpointinglist, mode=mode,  
             vis=vis, imname=imname1, TPnoiseRegion=TPnoiseRegion, 
-            TPnoiseChannels=TPnoiseChannels)  
+            TPnoiseChannels=TPnoiseChannels, nvgrp=TPnvgrp)  
 
 
     # bring TP.ms and INT.ms on same spectral reference frame before tclean 
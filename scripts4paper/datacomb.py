@@ -18,6 +18,7 @@ import sys
 import glob
 import numpy as np
 import re
+import datetime
 from importlib import reload
 
 import analysisUtils as au
@@ -1287,7 +1288,8 @@ def runWSM(vis,
 
 #################################
 
-def runfeather(intimage,intpb, sdimage, sdfactor = 1.0, featherim='featherim'):
+def runfeather(intimage,intpb, sdimage, sdfactor = 1.0, featherim='featherim',
+               method='casa', tol=0.01):
     """
     runfeather (A. Plunkett, NRAO)
     a wrapper around the CASA task "FEATHER,"
@@ -1312,6 +1314,15 @@ def runfeather(intimage,intpb, sdimage, sdfactor = 1.0, featherim='featherim'):
     sdfactor - Scale factor to apply to Single Dish image
     featherim - the name of the output feather image
              default: 'featherim'
+    method - 'casa': the CASA task feather, on the PB attenuated SD copy
+             'numpy': npfeather(), which streams blocks of channels of the
+                      three images and only writes the .image and .image.pbcor
+             'check': 'casa', and report the difference of 'numpy' with it
+             default: 'casa'
+    tol - relative rms difference (numpy-casa)/casa above which method='check'
+          warns; differences come from the FFT padding and interpolation of
+          the gaussian weights in CASA and are typically well below 1%
+             default: 0.01
 
 
     Example: runfeather(intimage='',intpb='',sdimage='',featherim='')
@@ -1351,6 +1362,12 @@ def runfeather(intimage,intpb, sdimage, sdfactor = 1.0, featherim='featherim'):
     print('### Start feather for sdfactor', sdfactor)       
     print('')                    
              
+    if method == 'numpy':
+        os.system('rm -rf '+featherim+'.*')
+        if not npfeather(myintimage, myintpb, mysdimage, sdfactor, featherim):
+            return False
+        export_fits(featherim, clean_origin=myintimage.replace('.image', ''))
+        return True
 
     os.system('rm -rf lowres.* ')
 
@@ -1409,17 +1426,240 @@ def runfeather(intimage,intpb, sdimage, sdfactor = 1.0, featherim='featherim'):
 
     os.system('rm -rf lowres.*')
 
+    if method == 'check':
+        if not npfeather(myintimage, myintpb, mysdimage, sdfactor, featherim+'_npcheck'):
+            return False
+        for suffix in ['.image', '.image.pbcor']:
+            reldiff = imreldiff(featherim+'_npcheck'+suffix, featherim+suffix)
+            print('FEATHER check %s: rms(numpy-casa)/rms(casa) = %g' % (suffix, reldiff))
+            if reldiff > tol:
+                print('WARNING: numpy feather differs from casa by more than tol =', tol)
+        os.system('rm -rf '+featherim+'_npcheck.*')
+
+    return True
+
+
+
+def runfeather_sweep(intimage, intpb, sdimage, sdfactors=[1.0], featherims=None,
+                     method='casa', tol=0.01):
+    """
+    run runfeather for a list of sdfactors, with one output image per sdfactor
+
+    With method='numpy' the feathered images for all sdfactors are written 
+    in one pass of npfeather over the three input images: the FFTs of the 
+    INT and PB attenuated SD planes are done once per block of channels, 
+    and the result is linear in sdfactor. Otherwise runfeather is run for 
+    each sdfactor with this method.
+
+    intimage, intpb, sdimage - as in runfeather
+    sdfactors - list of scale factors to apply to the Single Dish image
+    featherims - list of the names of the output feather images, one per 
+             sdfactor; default: 'featherim_f'+str(sdfactor)
+    method, tol - as in runfeather
+             default: 'casa'
+
+    The .image, .image.pbcor and .pb (and their FITS) products are named
+    as those of runfeather.
+
+    Example: runfeather_sweep(intimage='',intpb='',sdimage='',sdfactors=[0.8,1.0,1.2],
+                              featherims=['f0.8','f1.0','f1.2'])
+    """
+    if featherims == None:
+        featherims = ['featherim_f'+str(f) for f in sdfactors]
+    if len(featherims) != len(sdfactors):
+        print('ERROR: need one featherim per sdfactor')
+        return False
+
+    if method != 'numpy':
+        for (sdfactor, featherim) in zip(sdfactors, featherims):
+            if not runfeather(intimage, intpb, sdimage, sdfactor=sdfactor,
+                              featherim=featherim, method=method, tol=tol):
+                return False
+        return True
+
+    mysdimage = file_check(sdimage)
+    myintimage = file_check(intimage)
+    myintpb = file_check(intpb)
+
+    print('')                    
+    print('### Start feather for sdfactors', sdfactors)       
+    print('')                    
+
+    for featherim in featherims:
+        os.system('rm -rf '+featherim+'.*')
+    if not npfeather(myintimage, myintpb, mysdimage, list(sdfactors), list(featherims)):
+        return False
+    for featherim in featherims:
+        export_fits(featherim, clean_origin=myintimage.replace('.image', ''))
+
+    return True
+
+
+
+def planebeam(rbeam, chan):
+    """
+    return the (major, minor, positionangle) [rad] of channel chan from 
+    a restoringbeam() record, with or without per-plane beams
+
+    a helper for npfeather
+    """
+    _qa = qatool()
+    if 'beams' in rbeam:
+        b = rbeam['beams']['*%d' % chan]['*0']
+    else:
+        b = rbeam
+    return (_qa.convert(b['major'], 'rad')['value'],
+            _qa.convert(b['minor'], 'rad')['value'],
+            _qa.convert(b['positionangle'], 'rad')['value'])
+
+
+
+def gaussft(fx, fy, beam):
+    """
+    return the Fourier transform of a gaussian beam (major, minor, pa) [rad],
+    normalized to 1 at the origin, on the grid of spatial frequencies 
+    fx (along RA), fy (along Dec) [1/rad]; pa is from north to east
+
+    a helper for npfeather
+    """
+    (bmaj, bmin, bpa) = beam
+    umaj = fx*np.sin(bpa) + fy*np.cos(bpa)       # along the major axis
+    umin = fx*np.cos(bpa) - fy*np.sin(bpa)
+    return np.exp(-np.pi**2/(4.0*np.log(2.0))*((bmaj*umaj)**2 + (bmin*umin)**2))
+
+
+
+def npfeather(intimage, intpb, sdimage, sdfactor, featherim, nblock=0):
+    """
+    feather in numpy: the feather and PB correction steps of runfeather 
+    in one pass over blocks of channels, writing only featherim.image 
+    and featherim.image.pbcor
+
+    Per plane, with W the FT of the SD beam normalized to 1 at the origin:
+       FT(feather) = FT(INT)*(1-W) + sdfactor*(Omega_INT/Omega_SD)*FT(SD*PB)*W
+    as cta.feather(lowpassfiltersd=True) on the PB attenuated SD image.
+    Masked pixels count as zero; the .image gets the mask of intimage and
+    the .image.pbcor that of intimage and intpb, as immath gives them.
+    The images must be on the same grid, with RA/DEC/Stokes/Spectral axes.
+
+    sdfactor and featherim can also be lists of the same length: as the
+    feather is linear in sdfactor, the two terms are transformed once per
+    block and all featherim[i] (for sdfactor[i]) are written in the same pass.
+
+    a helper for runfeather and runfeather_sweep
+    """
+    if type(sdfactor) != type([]):
+        sdfactor  = [sdfactor]
+        featherim = [featherim]
+
+    _ia = iatool()
+    _ib = iatool()
+    _ic = iatool()
+    _ia.open(intimage)
+    _ib.open(intpb)
+    _ic.open(sdimage)
+    shape = _ia.shape()
+    if list(_ib.shape()) != list(shape) or list(_ic.shape()) != list(shape):
+        for t in [_ia, _ib, _ic]:
+            t.close()
+        print('ERROR: npfeather needs intimage, intpb and sdimage on the same grid')
+        return False
+    _qa  = qatool()
+    csys = _ia.coordsys()
+    incr = [_qa.convert({'value': d, 'unit': u}, 'rad')['value'] for (d, u) in
+            zip(csys.increment(type='direction')['numeric'], csys.units(type='direction'))]
+    csys.done()                                 # [rad], with sign
+    intbeams = _ia.restoringbeam()
+    sdbeams  = _ic.restoringbeam()
+    (nx, ny, npol, nchan) = shape
+
+    # spatial frequencies of the rfft2 grid [1/rad]
+    fx = np.fft.fftfreq(nx, d=incr[0])[:, None]
+    fy = np.fft.rfftfreq(ny, d=abs(incr[1]))[None, :] * np.sign(incr[1])
+
+    outim = [t2v.imlike(f+'.image', intimage, masks=[intimage]) for f in featherim]
+    outpc = [t2v.imlike(f+'.image.pbcor', intimage, masks=[intimage, intpb]) for f in featherim]
+
+    nblk = t2v.chanblock(nx, ny*npol, nchan, nblock)
+    print('npfeather: %d channels per block' % nblk)
+    for c0 in range(0, nchan, nblk):
+        c1    = min(c0+nblk, nchan) - 1
+        blc   = [0, 0, 0, c0]
+        trc   = [nx-1, ny-1, npol-1, c1]
+        hi    = _ia.getchunk(blc, trc)
+        hi[~_ia.getchunk(blc, trc, getmask=True)] = 0.0
+        pb    = _ib.getchunk(blc, trc)
+        pbm   = _ib.getchunk(blc, trc, getmask=True)
+        lo    = _ic.getchunk(blc, trc) * pb
+        lo[~(pbm & _ic.getchunk(blc, trc, getmask=True))] = 0.0
+        hift  = np.fft.rfft2(hi, axes=(0, 1))
+        loft  = np.fft.rfft2(lo, axes=(0, 1))
+        del hi, lo
+        for k in range(c1-c0+1):
+            bint  = planebeam(intbeams, c0+k)
+            bsd   = planebeam(sdbeams, c0+k)
+            wsd   = gaussft(fx, fy, bsd)[:, :, None]
+            ratio = (bint[0]*bint[1])/(bsd[0]*bsd[1])
+            hift[:, :, :, k] *= 1.0-wsd
+            loft[:, :, :, k] *= ratio*wsd
+        if len(sdfactor) == 1:                  # one inverse FFT
+            hift += sdfactor[0]*loft
+            terms = [np.fft.irfft2(hift, s=(nx, ny), axes=(0, 1))]
+        else:                                   # INT and SD terms
+            terms = [np.fft.irfft2(hift, s=(nx, ny), axes=(0, 1)),
+                     np.fft.irfft2(loft, s=(nx, ny), axes=(0, 1))]
+        del hift, loft
+        pb[~pbm] = 1.0                          # masked in the pbcor anyway
+        for i in range(len(featherim)):
+            if len(terms) == 1:
+                feath = terms[0]
+            else:
+                feath = terms[0] + sdfactor[i]*terms[1]
+            outim[i].putchunk(feath, blc=blc)
+            outpc[i].putchunk(feath/pb, blc=blc)
+            del feath
+        del terms, pb, pbm
+
+    for t in [_ia, _ib, _ic] + outim + outpc:
+        t.close()
     return True
 
 
 
+def imreldiff(image, refimage):
+    """
+    return rms(image-refimage)/rms(refimage) over the pixels unmasked in both,
+    one channel at a time
+
+    a helper for runfeather
+    """
+    _ia = iatool()
+    _ib = iatool()
+    _ia.open(image)
+    _ib.open(refimage)
+    shape = _ia.shape()
+    sumd  = 0.0
+    sumr  = 0.0
+    for c in range(shape[3]):
+        blc  = [0, 0, 0, c]
+        trc  = [shape[0]-1, shape[1]-1, shape[2]-1, c]
+        m    = _ia.getchunk(blc, trc, getmask=True) & _ib.getchunk(blc, trc, getmask=True)
+        ref  = _ib.getchunk(blc, trc)[m]
+        sumd += ((_ia.getchunk(blc, trc)[m] - ref)**2).sum()
+        sumr += (ref**2).sum()
+    _ia.close()
+    _ib.close()
+    return np.sqrt(sumd/sumr) if sumr > 0 else 0.0
+
+
+
 ######################################
 
 
 
 def feather_int_sd(sdcube='', intcube='', jointcube='',
                    sdgain=1.0,dishdia=100.0, usedata='sdint',         
-                   chanwt = ''): 
+                   chanwt = '', nproc=1, scratch='.'): 
     #, pbcube='',applypb=False, pblimit=0.2):
     """
     Taken from the SDINT_helper module inside CASA 5.8, state: July, 2021), 
@@ -1433,6 +1673,11 @@ def feather_int_sd(sdcube='', intcube='', jointcube='',
 
     TODO : Add the effdishdia  usage to get freq-indep feathering.
 
+    The channels are feathered by featherplane on a pool of nproc processes,
+    each in its own scratch directory below scratch, and the planes are
+    written into jointcube as they come back. Channels with chanwt==0 
+    (default: all 1) are left at zero without touching the input cubes.
+
     """
      
     ### Do the feathering.
@@ -1442,46 +1687,42 @@ def feather_int_sd(sdcube='', intcube='', jointcube='',
         #feather(imagename = jointcube, highres = intcube, lowres = sdcube, sdfactor = sdgain, effdishdiam=-1)
 
         freqlist = getFreqList(sdcube)
-        
-        os.system('rm -rf '+jointcube)
-        os.system('cp -r ' + intcube + ' ' + jointcube)
+        if len(chanwt) == 0:
+            chanwt = np.ones(len(freqlist))
 
-        _ia = iatool()
-        _ib = iatool() #image()
-        
-        from casatools import imager  as imtool
+        os.system('rm -rf '+jointcube)
+        _ia = t2v.imlike(jointcube, intcube, masks=[intcube])  # all planes zero
 
-        _ia.open(jointcube)
-        _ia.set(0.0) ## Initialize this to zero for all planes
-       
-        for i in range(len(freqlist)):  
+        dd = ''.join(re.findall('[0-9]', str(datetime.datetime.now())))
+        jobs = []
+        for i in range(len(freqlist)):
             if chanwt[i] != 0.0 : ## process only the nonzero channels
                 freqdishdia = dishdia ## * (freqlist[0] / freqlist[i]) # * 0.5
-            
-                os.system('rm -rf tmp_*')
-                #imsubimage(imagename = sdcube, outfile = 'tmp_sdplane', chans = str(i));
-                #imsubimage(imagename = intcube, outfile = 'tmp_intplane', chans = str(i));
-                createplaneimage(imagename=sdcube, outfile='tmp_sdplane', chanid = str(i));
-                createplaneimage(imagename=intcube, outfile='tmp_intplane', chanid = str(i));
-
-                #feather(imagename = 'tmp_jointplane', highres = 'tmp_intplane', lowres = 'tmp_sdplane', sdfactor = sdgain, effdishdiam=freqdishdia)
-                # feathering via toolkit
-                try: 
-                    cta.casalog.post("start Feathering.....")
-                    imFea=imtool( )
-                    imFea.setvp(dovp=True)
-                    imFea.setsdoptions(scale=sdgain)
-                    imFea.feather(image='tmp_jointplane',highres='tmp_intplane',lowres='tmp_sdplane', effdishdiam=freqdishdia)
-                    imFea.done( )
-                    del imFea
-                except Exception as instance:
-                    cta.casalog.post('*** Error *** %s' % instance, 'ERROR')
-                    raise 
-
-                _ib.open('tmp_jointplane')
-                pixjoint = _ib.getchunk()
-                _ib.close()
+                jobs.append({'sdcube': os.path.abspath(sdcube),
+                             'intcube': os.path.abspath(intcube),
+                             'chan': i, 'sdgain': sdgain, 'dishdia': freqdishdia,
+                             'scratch': os.path.abspath(os.path.join(scratch, 
+                                            'tmp_feather_%s_%d' % (dd, i)))})
+
+        nproc = max(1, min(nproc, len(jobs)))
+        if nproc == 1:
+            planes = map(featherplane, jobs)
+        else:
+            import multiprocessing as mp
+            ## fresh processes, the casatools of this one cannot be shared
+            pool = mp.get_context('spawn').Pool(nproc)
+            planes = pool.imap_unordered(featherplane, jobs, chunksize=1)
+        try:
+            for (i, pixjoint) in planes:
                 _ia.putchunk(pixjoint, blc=[0,0,0,i])
+        except Exception:
+            if nproc > 1:
+                pool.terminate()        # do not wait for the other channels
+            raise
+        finally:
+            if nproc > 1:
+                pool.close()
+                pool.join()
         
         _ia.close()
 
@@ -1497,6 +1738,49 @@ def feather_int_sd(sdcube='', intcube='', jointcube='',
     return True
 
 
+
+def featherplane(job):
+    """
+    feather one channel for feather_int_sd, in the scratch directory of the job
+    (a dict with sdcube, intcube, chan, sdgain, dishdia and scratch), 
+    which is removed afterwards; returns (chan, feathered plane)
+
+    a helper for feather_int_sd
+    """
+    from casatools import imager  as imtool
+
+    os.system('rm -rf '+job['scratch'])
+    os.makedirs(job['scratch'])
+    sdplane    = os.path.join(job['scratch'], 'sdplane')
+    intplane   = os.path.join(job['scratch'], 'intplane')
+    jointplane = os.path.join(job['scratch'], 'jointplane')
+    try:
+        createplaneimage(imagename=job['sdcube'], outfile=sdplane, chanid=str(job['chan']))
+        createplaneimage(imagename=job['intcube'], outfile=intplane, chanid=str(job['chan']))
+
+        # feathering via toolkit
+        try: 
+            cta.casalog.post("start Feathering.....")
+            imFea=imtool( )
+            imFea.setvp(dovp=True)
+            imFea.setsdoptions(scale=job['sdgain'])
+            imFea.feather(image=jointplane,highres=intplane,lowres=sdplane, 
+                          effdishdiam=job['dishdia'])
+            imFea.done( )
+            del imFea
+        except Exception as instance:
+            cta.casalog.post('*** Error *** %s' % instance, 'ERROR')
+            raise 
+
+        _ib = iatool()
+        _ib.open(jointplane)
+        pixjoint = _ib.getchunk()
+        _ib.close()
+    finally:
+        os.system('rm -rf '+job['scratch'])
+    return (job['chan'], pixjoint)
+
+
 def getFreqList(imname=''):
     
     """
@@ -2779,12 +3063,19 @@ def make_masks_and_thresh(imnameth, threshmask,
                     cube_rms = 3.,   
                     cont_chans ='2~4',
                     theoreticalRMS=False,
-                    makemask=True
+                    makemask=True,
+                    method='casa'
                     ):
     """
     make_masks_and_thresh (L. Moser-Fischer)
     wrapper for making all masks for DC_run
 
+    method - 'casa': derive_threshold and make_SD_mask, and immath to combine
+             'numpy': npmasks, which measures the RMS and peak in a first pass
+                      and makes all three masks in one pass over the template 
+                      and SD images, without the intermediate images
+             default: 'casa'
+
     steps:
     - helper functions for header information (beam, etc.)
 
@@ -2800,6 +3091,17 @@ def make_masks_and_thresh(imnameth, threshmask,
     """
 
 
+    if method == 'numpy':
+        print(' ')         
+        print('--- Derive a threshold, and make the threshold, SD and combined masks --- ')
+        thresh = npmasks(imnameth, threshmask, sdimage, sdmasklev, SD_mask_root,
+                         combined_mask, specmode=specmode, smoothing=smoothing,
+                         threshregion=threshregion, RMSfactor=RMSfactor, 
+                         cube_rms=cube_rms, cont_chans=cont_chans,
+                         theoreticalRMS=theoreticalRMS)
+        print('--- Combined mask done! --- ')    
+        return thresh
+
     # derive a simple threshold and make a mask from it 
     print(' ')         
     print('--- Derive a simple threshold from a dirty image and make a mask from it --- ')                                  
@@ -2854,6 +3156,180 @@ def make_masks_and_thresh(imnameth, threshmask,
 
 
 
+def chanlist(chans, nchan):
+    """
+    return the channel numbers of a channel selection like '2~5;10~12' 
+    or '3,7' (an spw prefix '0:' is ignored); '' selects all nchan channels
+
+    a helper for npmasks
+    """
+    if chans == '':
+        return list(range(nchan))
+    sel = []
+    for part in re.split('[;,]', chans.split(':')[-1]):
+        if '~' in part:
+            (c0, c1) = part.split('~')
+            sel += list(range(int(c0), int(c1)+1))
+        elif part.strip() != '':
+            sel.append(int(part))
+    return [c for c in sel if 0 <= c < nchan]
+
+
+
+def boxmask(box, nx, ny):
+    """
+    return the [nx,ny] pixel selection of an imstat box 'x0,y0,x1,y1[,...]'
+    (corners inclusive, several boxes are combined); '' selects all pixels
+
+    a helper for npmasks
+    """
+    if box == '':
+        return np.ones((nx, ny), bool)
+    sel = np.zeros((nx, ny), bool)
+    b = [int(float(v)) for v in box.split(',')]
+    for i in range(0, len(b)-3, 4):
+        sel[min(b[i],b[i+2]):max(b[i],b[i+2])+1, min(b[i+1],b[i+3]):max(b[i+1],b[i+3])+1] = True
+    return sel
+
+
+
+def npmasks(imnameth, threshmask, sdimage, sdmasklev, SD_mask_root, combined_mask,
+            specmode='mfs', smoothing=5, threshregion='', RMSfactor=0.5, cube_rms=3.,
+            cont_chans='2~4', theoreticalRMS=False, nblock=0):
+    """
+    derive_threshold, make_SD_mask and the combination of their masks in numpy.
+
+    A first pass reads what the statistics need: the template image (mfs, in
+    the threshregion box) or its cont_chans for the RMS per pixel (the moment 6 
+    map, cube), and the peak of the SD image. The second pass reads both images 
+    once per block of channels and writes threshmask.mask, SD_mask_root.mask 
+    and combined_mask, as the immath/imsmooth chain does:
+    - threshold mask: template > thresh, smoothed by a circular gaussian of
+      smoothing times the geometric mean beam (as imsmooth, including its 
+      Jy/beam scaling), then > 0.2
+    - SD mask: SD > sdmasklev * peak
+    - combined: either of the two
+    The _1.mask, _conv.mask and .mom6 images are not made.
+    Returns the threshold
+
+    a helper for make_masks_and_thresh
+    """
+    from scipy.ndimage import gaussian_filter1d
+
+    file_check(imnameth+'.image')
+    file_check(sdimage)
+
+    _ia = iatool()
+    _ib = iatool()
+    _ia.open(imnameth+'.image')
+    _ib.open(sdimage)
+    shape = _ia.shape()
+    if list(_ib.shape()) != list(shape):
+        _ia.close()
+        _ib.close()
+        raise Exception('ERROR: npmasks needs the template and SD image on the same grid')
+    (nx, ny, npol, nchan) = shape
+    nblk = t2v.chanblock(nx, ny*npol, nchan, nblock)
+
+    #### first pass: the statistics
+    box = boxmask(threshregion, nx, ny)[:, :, None, None]
+    if theoreticalRMS == True:
+        if specmode == 'mfs':
+            sumwt  = cta.imstat(imnameth+'.sumwt')['mean'][0]
+            factor = RMSfactor
+        else:
+            sumwt  = cta.imstat(imnameth+'.sumwt', chans=cont_chans)['mean'][0]
+            factor = cube_rms
+        thRMS  = np.sqrt(1/sumwt)
+        thresh = thRMS*factor
+        print('The theoretical RMS is', round(thRMS,decimal_places), 'Jy')
+    elif specmode == 'mfs':
+        (sum2, npix) = (0.0, 0)
+        for c0 in range(0, nchan, nblk):
+            c1  = min(c0+nblk, nchan) - 1
+            sel = _ia.getchunk([0,0,0,c0], [nx-1,ny-1,npol-1,c1], getmask=True) & box
+            sum2 += (_ia.getchunk([0,0,0,c0], [nx-1,ny-1,npol-1,c1])[sel]**2).sum()
+            npix += sel.sum()
+        full_RMS = np.sqrt(sum2/npix)
+        thresh   = full_RMS*RMSfactor
+        print('The RMS of the template image (box "' + threshregion + '") is', 
+              round(full_RMS,decimal_places), 'Jy')
+    else:                                       # RMS of the moment 6 map
+        sum2 = np.zeros((nx, ny, npol))
+        nsum = np.zeros((nx, ny, npol))
+        for c in chanlist(cont_chans, nchan):
+            m     = _ia.getchunk([0,0,0,c], [nx-1,ny-1,npol-1,c], getmask=True)[:, :, :, 0]
+            plane = _ia.getchunk([0,0,0,c], [nx-1,ny-1,npol-1,c])[:, :, :, 0]
+            sum2 += np.where(m, plane, 0.0)**2
+            nsum += m
+        sel      = (nsum > 0) & box[:, :, :, 0]
+        cube_RMS = np.sqrt(np.mean(sum2[sel]/nsum[sel]))
+        thresh   = cube_RMS*cube_rms
+        print('The RMS of the cube (check cont_chans for emission-free channels) is ', 
+              round(cube_RMS,decimal_places), 'Jy.')
+    print('The mask threshold is', round(thresh,decimal_places), 'Jy')
+
+    maxSD = -np.inf
+    for c0 in range(0, nchan, nblk):
+        c1  = min(c0+nblk, nchan) - 1
+        sel = _ib.getchunk([0,0,0,c0], [nx-1,ny-1,npol-1,c1], getmask=True)
+        if sel.any():
+            maxSD = max(maxSD, _ib.getchunk([0,0,0,c0], [nx-1,ny-1,npol-1,c1])[sel].max())
+    sdmaskval = sdmasklev*maxSD
+
+    #### smoothing kernel, as derive_threshold gives it to imsmooth
+    _qa   = qatool()
+    csys  = _ia.coordsys()
+    incr  = [abs(_qa.convert({'value': d, 'unit': u}, 'rad')['value']) for (d, u) in
+             zip(csys.increment(type='direction')['numeric'], csys.units(type='direction'))]
+    csys.done()
+    beams = _ia.restoringbeam()
+    jypb  = _ia.brightnessunit() == 'Jy/beam'
+    bmid  = planebeam(beams, nchan//2)
+    apr   = _qa.convert('1rad', 'arcsec')['value']
+    BeamAvg = np.sqrt(bmid[0]*bmid[1])*apr
+    kfwhm = smoothing*round(BeamAvg, 6)/apr     # [rad]
+    sigx  = kfwhm/np.sqrt(8.0*np.log(2.0))/incr[0]  # [pixels]
+    sigy  = kfwhm/np.sqrt(8.0*np.log(2.0))/incr[1]
+    print('Use a geometric average for smoothing of', round(BeamAvg, 6), 'arcsec')
+    _ia.close()
+    _ib.close()
+
+    #### second pass: the masks
+    os.system('rm -rf '+threshmask+'*.mask')
+    os.system('rm -rf '+SD_mask_root+'.mask')
+    os.system('rm -rf '+combined_mask)
+    outth = t2v.imlike(threshmask+'.mask', imnameth+'.image', masks=[imnameth+'.image'])
+    outsd = t2v.imlike(SD_mask_root+'.mask', sdimage, masks=[sdimage])
+    outcb = t2v.imlike(combined_mask, sdimage, masks=[sdimage, imnameth+'.image'])
+    _ia.open(imnameth+'.image')
+    _ib.open(sdimage)
+    for c0 in range(0, nchan, nblk):
+        c1   = min(c0+nblk, nchan) - 1
+        blc  = [0, 0, 0, c0]
+        trc  = [nx-1, ny-1, npol-1, c1]
+        mth  = (_ia.getchunk(blc, trc) > round(thresh,6)) & _ia.getchunk(blc, trc, getmask=True)
+        conv = gaussian_filter1d(mth.astype(float), sigx, axis=0, mode='constant')
+        conv = gaussian_filter1d(conv, sigy, axis=1, mode='constant')
+        if jypb:                                # imsmooth keeps Jy/beam
+            for k in range(c1-c0+1):
+                b = planebeam(beams, c0+k)
+                conv[:, :, :, k] *= np.sqrt((b[0]**2+kfwhm**2)*(b[1]**2+kfwhm**2))/(b[0]*b[1])
+        mth  = conv > 0.2
+        del conv
+        msd  = _ib.getchunk(blc, trc) > round(sdmaskval,6)
+        outth.putchunk(mth.astype(float), blc=blc)
+        outsd.putchunk(msd.astype(float), blc=blc)
+        outcb.putchunk((mth | msd).astype(float), blc=blc)
+        del mth, msd
+
+    for t in [_ia, _ib, outth, outsd, outcb]:
+        t.close()
+    print('### Done! Created the threshold, SD and combined masks')                
+    return thresh
+
+
+
 
 
 
@@ -2864,7 +3340,7 @@ def make_masks_and_thresh(imnameth, threshmask,
 ######################################
 
 def ssc(highres=None, lowres=None, pb=None, combined=None, 
-        sdfactor=1.0):
+        sdfactor=1.0, method='casa', tol=0.01):
     """
     ssc (P. Teuben, N. Pingel, L. Moser-Fischer)
     an implementation of Faridani's short spacing combination method
@@ -2892,6 +3368,13 @@ def ssc(highres=None, lowres=None, pb=None, combined=None,
     pb       - high resolution (interferometer) primary beam image 
     combined - output image name base 
     sdfactor - scaling factor for the SD/TP contribution
+    method   - 'casa': the immath/imsmooth chain below
+               'numpy': npssc(), one pass over blocks of channels of the 
+                        three images, only the .image and .image.pbcor are written
+               'check': 'casa', and report the difference of 'numpy' with it
+               default: 'casa'
+    tol      - relative rms difference (numpy-casa)/casa above which 
+               method='check' warns; default: 0.01
 
     Example: ssc(highres='INT.image', lowres='SD.image', pb='INT.pb',
                  combined='INT_SD_1.7', sdfactor=1.7)
@@ -2901,20 +3384,25 @@ def ssc(highres=None, lowres=None, pb=None, combined=None,
     
     ######################  Helper Functions  ##################### 
     
+    # image summaries, read once per image
+    summaries = {}
+    def getSummary(imName):
+            if str(imName) not in summaries:
+                    myia=iatool()
+                    myia.open(str(imName))
+                    summaries[str(imName)] = myia.summary()
+                    myia.close()
+            return summaries[str(imName)]
+
     # BUNIT from the header
     def getBunit(imName):     
-            myia=iatool()   
-            myia.open(str(imName))
-            summary = myia.summary()
-            myia.close()    
+            summary = getSummary(imName)
             
             return summary['unit']
     
     # BMAJ beam major axis in units of arcseconds
     def getBmaj(imName):
-            myia=iatool() 
-            myia.open(str(imName))
-            summary = myia.summary()
+            summary = getSummary(imName)
             if 'perplanebeams' in summary:
                     n = summary['perplanebeams']['nChannels']//2
                     b = summary['perplanebeams']['beams']['*%d' % n]['*0']
@@ -2925,15 +3413,12 @@ def ssc(highres=None, lowres=None, pb=None, combined=None,
             major_value = major['value']
             if unit == 'deg':
                     major_value = major_value * 3600
-            myia.close()                    
                     
             return major_value
     
     # BMIN beam minor axis in units of arcseconds
     def getBmin(imName):
-            myia=iatool() 
-            myia.open(str(imName))
-            summary = myia.summary()
+            summary = getSummary(imName)
             if 'perplanebeams' in summary:
                     n = summary['perplanebeams']['nChannels']//2
                     b = summary['perplanebeams']['beams']['*%d' % n]['*0']
@@ -2945,15 +3430,12 @@ def ssc(highres=None, lowres=None, pb=None, combined=None,
             minor_value = minor['value']
             if unit == 'deg':
                     minor_value = minor_value * 3600
-            myia.close()    
                 
             return minor_value
     
     # Position angle of the interferometeric data
     def getPA(imName):
-            myia=iatool() 
-            myia.open(str(imName))
-            summary = myia.summary()
+            summary = getSummary(imName)
             if 'perplanebeams' in summary:
                     n = summary['perplanebeams']['nChannels']//2
                     b = summary['perplanebeams']['beams']['*%d' % n]['*0']
@@ -2962,7 +3444,6 @@ def ssc(highres=None, lowres=None, pb=None, combined=None,
     
             pa_value = b['positionangle']['value']
             pa_unit  = b['positionangle']['unit']
-            myia.close()    
             
             return pa_value, pa_unit
     
@@ -3001,6 +3482,13 @@ def ssc(highres=None, lowres=None, pb=None, combined=None,
     print('### Start Faridani SSC for sdfactor', sdfactor)       
     print('')  
 
+    if method == 'numpy':
+        os.system('rm -rf '+combined+'.image*')
+        if not npssc(highres, lowres, pb, sdfactor, combined):
+            return False
+        export_fits(combined, clean_origin=pb.replace('.pb', ''))
+        return True
+
 
 
     #  @todo   this is dangerous, need to find temp names 
@@ -3153,11 +3641,197 @@ def ssc(highres=None, lowres=None, pb=None, combined=None,
     os.system('rm -rf '+sub_bc)
     #os.system('rm -rf '+combined)
     #os.system('rm -rf '+combined+'.pbcor')
+
+    if method == 'check':
+        combined = combined[:-len('.image')]
+        if not npssc(highres, lowres, pb, sdfactor, combined+'_npcheck'):
+            return False
+        for suffix in ['.image', '.image.pbcor']:
+            reldiff = imreldiff(combined+'_npcheck'+suffix, combined+suffix)
+            print('SSC check %s: rms(numpy-casa)/rms(casa) = %g' % (suffix, reldiff))
+            if reldiff > tol:
+                print('WARNING: numpy SSC differs from casa by more than tol =', tol)
+        os.system('rm -rf '+combined+'_npcheck.*')
     
     return True
 
 
 
+def ssc_sweep(highres=None, lowres=None, pb=None, combineds=None,
+              sdfactors=[1.0], method='casa', tol=0.01):
+    """
+    run ssc for a list of sdfactors, with one combined image per sdfactor
+
+    With method='numpy' the combined images for all sdfactors are written 
+    in one pass of npssc over the three input images. Otherwise ssc is run 
+    for each sdfactor with this method.
+
+    highres, lowres, pb - as in ssc
+    combineds - list of output image name bases, one per sdfactor
+    sdfactors - list of scaling factors for the SD/TP contribution
+    method, tol - as in ssc
+             default: 'casa'
+
+    Example: ssc_sweep(highres='INT.image', lowres='SD.image', pb='INT.pb',
+                       combineds=['INT_SD_1.0','INT_SD_1.7'], sdfactors=[1.0,1.7])
+    """
+    if combineds == None or len(combineds) != len(sdfactors):
+        print('ERROR: need one combined per sdfactor')
+        return False
+
+    if method != 'numpy':
+        for (sdfactor, combined) in zip(sdfactors, combineds):
+            if not ssc(highres=highres, lowres=lowres, pb=pb, combined=combined,
+                       sdfactor=sdfactor, method=method, tol=tol):
+                return False
+        return True
+
+    file_check(lowres)
+    file_check(highres)
+    file_check(pb)
+
+    print('')                    
+    print('### Start Faridani SSC for sdfactors', sdfactors)       
+    print('')  
+
+    for combined in combineds:
+        os.system('rm -rf '+combined+'.image*')
+    if not npssc(highres, lowres, pb, list(sdfactors), list(combineds)):
+        return False
+    for combined in combineds:
+        export_fits(combined, clean_origin=pb.replace('.pb', ''))
+
+    return True
+
+
+
+def npssc(highres, lowres, pb, sdfactor, combined, nblock=0):
+    """
+    Faridani's SSC in numpy: the steps of ssc in one pass over blocks of
+    channels, writing only combined.image and combined.image.pbcor
+
+    Per plane, with lowres multiplied by pb, and highres_conv the highres
+    convolved (by FFT) to the lowres beam at the highres position angle, 
+    as imsmooth(targetres=True) does it for each plane:
+       combined = highres + w*(sdfactor*lowres - highres_conv)
+    with w the highres/lowres beam area ratio (of the middle channel) for
+    a Jy/beam lowres, and w=1 for Kelvin. The result is linear in sdfactor, 
+    so sdfactor and combined can also be lists, all written in the same pass.
+    Masked pixels count as zero; the outputs get the masks of the three
+    images, and the brightness unit of lowres, as the immath chain in ssc.
+
+    a helper for ssc and ssc_sweep
+    """
+    if type(sdfactor) != type([]):
+        sdfactor = [sdfactor]
+        combined = [combined]
+
+    _ia = iatool()
+    _ib = iatool()
+    _ic = iatool()
+    _ia.open(highres)
+    _ib.open(pb)
+    _ic.open(lowres)
+    shape = _ia.shape()
+    if list(_ib.shape()) != list(shape) or list(_ic.shape()) != list(shape):
+        for t in [_ia, _ib, _ic]:
+            t.close()
+        print('ERROR: npssc needs highres, pb and lowres on the same grid')
+        return False
+    _qa  = qatool()
+    csys = _ia.coordsys()
+    incr = [_qa.convert({'value': d, 'unit': u}, 'rad')['value'] for (d, u) in
+            zip(csys.increment(type='direction')['numeric'], csys.units(type='direction'))]
+    csys.done()                                 # [rad], with sign
+    hrbeams = _ia.restoringbeam()
+    lrbeams = _ic.restoringbeam()
+    hrunit  = _ia.brightnessunit()
+    lrunit  = _ic.brightnessunit()
+    (nx, ny, npol, nchan) = shape
+
+    # target beam and weighting factor, from the middle channel as in ssc
+    hrmid  = planebeam(hrbeams, nchan//2)
+    lrmid  = planebeam(lrbeams, nchan//2)
+    target = (lrmid[0], lrmid[1], hrmid[2])
+    if lrunit == 'Jy/beam':
+        w = (hrmid[0]*hrmid[1])/(lrmid[0]*lrmid[1])
+    elif lrunit == 'Kelvin' or lrunit == 'K':
+        w = 1.0
+    else:
+        for t in [_ia, _ib, _ic]:
+            t.close()
+        print('ERROR: npssc needs lowres in Jy/beam or Kelvin, not', lrunit)
+        return False
+    print('Weighting factor: ' + str(w))
+
+    # spatial frequencies of the rfft2 grid [1/rad]
+    fx = np.fft.fftfreq(nx, d=incr[0])[:, None]
+    fy = np.fft.rfftfreq(ny, d=abs(incr[1]))[None, :] * np.sign(incr[1])
+    c  = np.pi**2/(4.0*np.log(2.0))
+    def expo(beam):                             # ln gaussft(fx, fy, beam)
+        (bmaj, bmin, bpa) = beam
+        return -c*((bmaj*(fx*np.sin(bpa) + fy*np.cos(bpa)))**2 +
+                   (bmin*(fx*np.cos(bpa) - fy*np.sin(bpa)))**2)
+
+    masks = [highres, lowres, pb]
+    outim = [t2v.imlike(f+'.image', highres, masks=masks) for f in combined]
+    outpc = [t2v.imlike(f+'.image.pbcor', highres, masks=masks) for f in combined]
+    for t in outim + outpc:
+        t.setbrightnessunit(lrunit)
+
+    nblk = t2v.chanblock(nx, ny*npol, nchan, nblock)
+    print('npssc: %d channels per block' % nblk)
+    ok = True
+    for c0 in range(0, nchan, nblk):
+        c1    = min(c0+nblk, nchan) - 1
+        blc   = [0, 0, 0, c0]
+        trc   = [nx-1, ny-1, npol-1, c1]
+        hr    = _ia.getchunk(blc, trc)
+        hr[~_ia.getchunk(blc, trc, getmask=True)] = 0.0
+        pbb   = _ib.getchunk(blc, trc)
+        pbm   = _ib.getchunk(blc, trc, getmask=True)
+        lo    = _ic.getchunk(blc, trc) * pbb
+        lo[~(pbm & _ic.getchunk(blc, trc, getmask=True))] = 0.0
+
+        # highres convolved to the target beam, plane by plane
+        hrft  = np.fft.rfft2(hr, axes=(0, 1))
+        for k in range(c1-c0+1):
+            hrk   = planebeam(hrbeams, c0+k)
+            kexp  = expo(target) - expo(hrk)    # ln of the kernel FT
+            if kexp.max() > 1.0e-6:
+                print('ERROR: channel %d: the lowres beam is not larger than the highres beam' % (c0+k))
+                ok = False
+                break
+            scale = 1.0
+            if hrunit == 'Jy/beam':             # Jy per target beam
+                scale = (target[0]*target[1])/(hrk[0]*hrk[1])
+            hrft[:, :, :, k] *= scale*np.exp(kexp)[:, :, None]
+        if not ok:
+            break
+        hrconv = np.fft.irfft2(hrft, s=(nx, ny), axes=(0, 1))
+        del hrft
+
+        # combined = (hr - w*hrconv) + sdfactor*(w*lo)
+        hr   -= w*hrconv
+        lo   *= w
+        del hrconv
+        pbb[~pbm] = 1.0                         # masked in the pbcor anyway
+        for i in range(len(combined)):
+            comb = hr + sdfactor[i]*lo
+            outim[i].putchunk(comb, blc=blc)
+            outpc[i].putchunk(comb/pbb, blc=blc)
+            del comb
+        del hr, lo, pbb, pbm
+
+    for t in [_ia, _ib, _ic] + outim + outpc:
+        t.close()
+    if not ok:                                  # partially written
+        for f in combined:
+            os.system('rm -rf '+f+'.image '+f+'.image.pbcor')
+    return ok
+
+
+
 
 
 
@@ -3320,7 +3994,7 @@ def ms_ptg(msfile, outfile=None, uniq=True):
 
 def create_TP2VIS_ms(imTP=None, TPresult=None,
     TPpointinglist=None, mode='mfs', vis=None, imname=None, TPnoiseRegion=None,
-    TPnoiseChannels=None
+    TPnoiseChannels=None, nvgrp=5
     ):
     """ 
     create_TP2VIS_ms (L. Moser-Fischer)
@@ -3340,6 +4014,8 @@ def create_TP2VIS_ms(imTP=None, TPresult=None,
     inmame - output praefix for weightplot
     TPnoiseRegion - if mode='mfs', emission-free box in cont image is used to determine noise
     TPnoiseChannels - if mode='cube', line-free channels in cube are used to determine noise
+    nvgrp - number of visibility groups per pointing (1035 visibilities each), 
+            or 'auto' to let tp2vis pick the smallest one that samples the TP beam
 
  
    """
@@ -3369,7 +4045,7 @@ def create_TP2VIS_ms(imTP=None, TPresult=None,
  
         print('Deriving TP.ms using image rms')
         print('rms in image:', rms) 
-        t2v.tp2vis(imTP,TPresult,TPpointinglist,nvgrp=5,rms=rms)# winpix=3)  # in CASA 6.x
+        t2v.tp2vis(imTP,TPresult,TPpointinglist,nvgrp=nvgrp,rms=rms)# winpix=3)  # in CASA 6.x
         #print('Deriving TP.ms from deconvolved image')        
         #t2v.tp2vis(imTP,TPresult,TPpointinglist,deconv=True,maxuv=10,nvgrp=4)
 
@@ -3389,7 +4065,7 @@ def create_TP2VIS_ms(imTP=None, TPresult=None,
         
         print('Deriving TP.ms using image rms')
         print('rms in image:', rms)    
-        t2v.tp2vis(imTP,TPresult,TPpointinglist,nvgrp=5,rms=rms)# winpix=3)  # in CASA 6.x
+        t2v.tp2vis(imTP,TPresult,TPpointinglist,nvgrp=nvgrp,rms=rms)# winpix=3)  # in CASA 6.x
         #t2v.tp2vis(imTP,TPresult,TPpointinglist,deconv=True,maxuv=10,nvgrp=4)
         #print('Derived TP.ms from deconvolved image')
 
@@ -0,0 +1,33 @@
+#
+#   nvgrp='auto' of tp2vis(): autonvgrp() on an ALMA-like setup; needs no CASA
+#
+
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import tp2vis as t2v
+
+
+def footprint(maxuv=10.0):
+    """ (npair, sigma, uvcut2) as tp2vis() passes them, at 100 GHz [m] """
+    arcsec = np.pi/180/3600
+    stof   = 2.0*np.sqrt(2.0*np.log(2.0))
+    lam    = 2.99792458e8/100.0e9
+    vi_sig = t2v.t2v_arrays['VIRTUAL']['fwhm100']*arcsec/stof
+    tp_sig = t2v.t2v_arrays['ALMATP']['fwhm100']*arcsec/stof
+    sigma  = lam/(2.0*np.pi*vi_sig)             # VI footprint sigma [m]
+    uvcut  = min(maxuv, np.sqrt(-2.0*np.log(0.01))*lam/(2.0*np.pi*tp_sig))
+    nant   = 46
+    return nant*(nant-1)//2, sigma, uvcut**2
+
+def test_auto_more_than_one():
+    """ the default tolerance asks for more than one visibility group """
+    npair, sigma, uvcut2 = footprint()
+    assert t2v.autonvgrp(npair, sigma, uvcut2, tol=0.1) > 1
+
+def test_auto_stays_below_tol():
+    """ larger tolerances never give a larger nvgrp """
+    npair, sigma, uvcut2 = footprint()
+    nv = [t2v.autonvgrp(npair, sigma, uvcut2, tol=tol, nvmax=8) for tol in [0.12, 0.15, 0.25]]
+    assert nv == sorted(nv, reverse=True)
@@ -0,0 +1,117 @@
+#
+#   pbvisgrid() and pbvisdegrid() of nppredict() against a direct DFT
+#   of a small image times a gaussian primary beam (needs no CASA), and
+#   nppredict() against sm.predict in tp2vis(predict='check') (needs casatools)
+#
+
+import os, sys, re
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import tp2vis as t2v
+
+
+arcsec = np.pi/180/3600
+
+def model(nchan=3):
+    rng    = np.random.default_rng(1)
+    nx, ny = 41, 37
+    image  = rng.random((nx,ny,nchan))
+    ptgpix = (19.3, 18.6)                       # not on a pixel
+    dxy    = (-2.0*arcsec, 2.0*arcsec)          # RA decreases with x
+    sig2   = ((12.0*arcsec)*np.linspace(1.0,0.9,nchan))**2
+    return image, ptgpix, dxy, sig2
+
+def dft(image, ptgpix, dxy, sig2, ul, vl, phcen=None):
+    """ vis[irow][iz] of image*beam, phase center at the pointing or phcen """
+    nx, ny, nchan = image.shape
+    if phcen == None:
+        phcen = ptgpix
+    l  = (np.arange(nx)-ptgpix[0])*dxy[0]
+    m  = (np.arange(ny)-ptgpix[1])*dxy[1]
+    lp = (np.arange(nx)-phcen[0])*dxy[0]
+    mp = (np.arange(ny)-phcen[1])*dxy[1]
+    vis = np.zeros(ul.shape, complex)
+    for iz in range(nchan):
+        pb  = image[:,:,iz]*np.exp(-(l[:,None]**2+m[None,:]**2)/(2.0*sig2[iz]))
+        ph  = np.exp(-2j*np.pi*(ul[:,iz,None,None]*lp[None,:,None] + vl[:,iz,None,None]*mp[None,None,:]))
+        vis[:,iz] = (pb[None,:,:]*ph).sum(axis=(1,2))
+    return vis
+
+def grid(dxy, hw, pad=8, uvmax=2000.0):
+    du = 1.0/(pad*(2*hw+1)*np.abs(dxy).min())
+    nu = int(np.ceil(uvmax/du)) + 1
+    return du, nu
+
+def test_pbvisgrid_cells():
+    """ on the uv cells the transform is exact (window covers the image) """
+    image, ptgpix, dxy, sig2 = model()
+    hw     = 25
+    du, nu = grid(dxy, hw)
+    gridFT = t2v.pbvisgrid(image, ptgpix, dxy, sig2, hw, du, nu)
+    assert gridFT.shape == (image.shape[2], 2*nu+1, 2*nu+1)
+    # the grid has its phase center at the pixel nearest to the pointing
+    center = (round(ptgpix[0]), round(ptgpix[1]))
+    uc     = np.arange(-nu,nu+1)*du
+    ul     = np.repeat(np.repeat(uc,2*nu+1)[:,None], image.shape[2], axis=1)
+    vl     = np.repeat(np.tile(uc,2*nu+1)[:,None], image.shape[2], axis=1)
+    ref    = dft(image, ptgpix, dxy, sig2, ul, vl, phcen=center)
+    got    = gridFT.reshape(image.shape[2],-1).T
+    assert np.abs(got-ref).max() < 1e-10*np.abs(ref).max()
+
+def test_pbvisdegrid_samples():
+    """ interpolated at random (u,v) it matches the DFT at the pointing """
+    image, ptgpix, dxy, sig2 = model()
+    hw     = 25
+    du, nu = grid(dxy, hw)
+    gridFT = t2v.pbvisgrid(image, ptgpix, dxy, sig2, hw, du, nu)
+    rng    = np.random.default_rng(2)
+    fz     = np.array([1.0, 1.05, 1.1])/0.003   # 1/lambda [1/m] at 3mm
+    uu     = rng.uniform(-5.0, 5.0, 200)        # [m], inside the 2000 lambda grid
+    vv     = rng.uniform(-5.0, 5.0, 200)
+    vis    = t2v.pbvisdegrid(gridFT, ptgpix, dxy, du, uu, vv, fz)
+    ref    = dft(image, ptgpix, dxy, sig2, uu[:,None]*fz[None,:], vv[:,None]*fz[None,:])
+    err    = np.sqrt(np.mean(np.abs(vis-ref)**2)/np.mean(np.abs(ref)**2))
+    assert err < 5e-3
+
+def test_nppredict_smpredict(tmp_path, capsys):
+    """ nppredict against sm.predict on a small cube: sign convention, phase
+    center shift to the pointings and Jy/pixel scaling. The default ALMA
+    voltage pattern of sm.predict is not quite the gaussian of nppredict,
+    so only a few percent agreement is expected """
+    casatools = pytest.importorskip('casatools')
+    cwd = os.getcwd()
+    os.chdir(tmp_path)                          # tp2vis writes tmp_* files here
+    try:
+        nx, nchan = 128, 2
+        csys = casatools.coordsys().newcoordsys(direction=True, spectral=True, stokes=['I'])
+        csys.setunits(type='direction', value='arcsec arcsec')   # not rad
+        csys.setreferencevalue(type='direction', value=[180.0*3600, -35.0*3600])
+        csys.setreferencepixel(type='direction', value=[nx/2, nx/2])
+        csys.setincrement(type='direction', value=[-4.0, 4.0])
+        csys.setreferencevalue(type='spectral', value=[100.0e9])
+        csys.setreferencepixel(type='spectral', value=[0.0])
+        csys.setincrement(type='spectral', value=[1.0e6])
+
+        # two offset gaussians, so a wrong sign or phase center shows up
+        x, y  = np.meshgrid(np.arange(nx), np.arange(nx), indexing='ij')
+        plane = np.exp(-((x-80)**2+(y-50)**2)/(2.0*6.0**2)) + \
+                0.5*np.exp(-((x-45)**2+(y-75)**2)/(2.0*4.0**2))
+        ia = casatools.image()
+        ia.fromshape('model.im', [nx,nx,1,nchan], csys=csys.torecord(), overwrite=True)
+        ia.putchunk(np.repeat(plane[:,:,None,None], nchan, axis=3))
+        ia.setbrightnessunit('Jy/beam')
+        ia.setrestoringbeam(major='58.3arcsec', minor='58.3arcsec', pa='0deg')
+        ia.close()
+        csys.done()
+
+        ptg = ['J2000 12h00m00.0s -35d00m00.0s',
+               'J2000 12h00m02.5s -34d59m30.0s',
+               'J2000 11h59m57.5s -35d00m40.0s']
+        t2v.tp2vis('model.im', 'model.ms', ptg, nvgrp=1, predict='check')
+        out = capsys.readouterr().out
+    finally:
+        os.chdir(cwd)
+    ratio = float(re.search(r'PREDICT check: .* ratio = (\S+)', out).group(1))
+    assert ratio < 0.15
@@ -10,7 +10,9 @@
 #
 # Public functions:
 #    tp2vis_version()
-#    tp2vis(imagename, msname, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True)
+#    tp2vis(imagename, msname, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, nblock=0, nproc=1, rfft=False, maxmem=None, predict='sm', cache=False, nvtol=0.1, export=None)
+#    tp2vis_batch(jobs, nproc=2, scratch='.', **kwargs)
+#    tp2visexport(msname, outfile, nrow=100000, nchunk=64)
 #    tp2visbl(imagename, ptg, maxuv=10.0, nvgrp=4, deconv=True)
 #    tp2viswt(mslist,mode='stat',value=0.5)
 #    tp2vistweak(dirtyname,cleanname,pbcut=0.8)
@@ -19,12 +21,33 @@
 # Helper functions:
 #    tp2vis_version()
 #    getptg()
+#    axorder()
 #    axinorder()
+#    axhead()
+#    axchunk()
 #    arangeax()
 #    guessarray()
+#    skelname()
+#    cachepurge()
+#    uvgrid2()
+#    schwabft()
+#    uvsample()
+#    uvwtile()
+#    chanblock()
+#    deconvolve()
+#    rdeconvolve()
+#    deconvpool()
+#    nppredict()
+#    wtupdate()
+#    fixtimes()
+#    visstore()
+#    storespw()
+#    storeread()
+#    uvbeam()
 #
 
-import os, sys, shutil, re, time, datetime
+import os, sys, shutil, re, time, datetime, hashlib
+from collections import OrderedDict
 import numpy as np
 import scipy as sp
 import matplotlib.pyplot as plt
@@ -139,6 +162,20 @@ dish3 = None
 # see also qac_vp()
 use_schwab = False
 
+# cache of deconvolution kernels (uvgrd2, schwab_ft), keyed by the geometry
+# of the cube. They are kept in memory up to t2v_cachemem bytes; set
+# t2v_cachedir (e.g. ~/.cache/tp2vis) to also keep them, and the skeleton
+# MS of tp2vis(cache=True), on disk. Nothing is evicted from t2v_cachedir,
+# see cachepurge().
+t2v_cachedir  = None
+t2v_cachemem  = 1.0e9                           # bytes of kernels kept in memory
+t2v_kernels   = OrderedDict()                   # in-memory LRU
+
+# cache of the weighted uv moments and amplitude spectra of an MS,
+# see uvmoments() and ampspectrum()
+t2v_uvmom     = {}
+t2v_spectra   = {}
+
 
 ## =================
 ## Support functions
@@ -148,9 +185,10 @@ def tp2vis_version():
     print("tp2vis: %s" % __version__)
 
    
-def axinorder(image):
+def axorder(image):
     """
-        Ensure we have the image in RA-DEC-POL-FREQ axes order.
+        Return the transpose order (e.g. '0132') that puts the axes of
+        image in RA-DEC-POL-FREQ order; '0123' if they already are.
         Helper function for tp2vis()
     """
     ia.open(image)
@@ -167,11 +205,46 @@ def axinorder(image):
         else:
             iax   = list(axname).index(ax)
             order = order + '%1d' % (iax)
+    return order
 
+def axinorder(image):
+    """
+        Ensure we have the image in RA-DEC-POL-FREQ axes order.
+        Helper function for tp2vis()
+    """
+    return axorder(image) == '0123'
+
+def axhead(h0, order):
+    """
+        Return a copy of the imhead(mode='list') header h0 with the shape
+        and the per axis keywords (ctype1, cdelt1, ...) in the RA-DEC-POL-FREQ
+        order given by axorder()
+        Helper function for tp2vis() and tp2visbl()
+    """
+    h1 = dict(h0)
     if order == '0123':
-        return True
-    else:
-        return False
+        return h1
+    perm = [int(c) for c in order]
+    h1['shape'] = np.array([h0['shape'][p] for p in perm])
+    for key in ['ctype','cdelt','crval','crpix','cunit']:
+        for i in range(len(perm)):
+            if key+'%d' % (perm[i]+1) in h0:
+                h1[key+'%d' % (i+1)] = h0[key+'%d' % (perm[i]+1)]
+    return h1
+
+def axchunk(image, order, iz0, iz1, getmask=False):
+    """
+        Read channels iz0..iz1 of the first polarization from the open
+        image tool, and return them as a RA-DEC-POL-FREQ view of the chunk,
+        whatever the axes order of the image is; order is from axorder().
+        Helper function for tp2vis() and nppredict()
+    """
+    perm = [int(c) for c in order]
+    blc  = [-1,-1,0,iz0]
+    trc  = [-1,-1,0,iz1]
+    blc  = [blc[perm.index(i)] for i in range(4)]   # in the image axes order
+    trc  = [trc[perm.index(i)] for i in range(4)]
+    return np.transpose(image.getchunk(blc,trc,getmask=getmask),perm)
 
 def arangeax(image):
     """
@@ -238,6 +311,11 @@ def guessarray(msfile):
     if not os.path.exists(msfile):              # make sure MS exists
         print("GUESSARRAY ERROR: no %s exists" % (msfile))
         return None
+    if isvisstore(msfile):                      # tp2visexport() store
+        f = visstore(msfile)
+        mostlikelyarray = str(f.attrs['array'])
+        visclose(f)
+        return mostlikelyarray
     tb.open(msfile+'/ANTENNA')                  # open MS
     antnames = tb.getcol('NAME')                # read ant names
     sizes = tb.getcol('DISH_DIAMETER')          # and dish sizes
@@ -262,7 +340,7 @@ def guessarray(msfile):
 
     return mostlikelyarray
 
-def schwab_spheroidal(alpha,m,rscale,dist2d):
+def schwab_spheroidal(alpha,m,rscale,dist2d,ntab=4096):
     """ return 2d kernel image of schwab's spheroidal function (Schwab 1984)
     
     CASA's sdimaging() uses the tabulated approx. of spheroidal function
@@ -284,21 +362,878 @@ def schwab_spheroidal(alpha,m,rscale,dist2d):
     m           Schwab's parameter m
     rscale      size of kernel - it becomes zero at pixel=rscale
     dist2d      2d image that contains distances from center
+    ntab        number of points in the radial lookup table, the function
+                is evaluated there and interpolated to dist2d
     """
     gamma        = m * np.pi / 2.0
-    schwab       = (1.0-(dist2d/rscale)**2)**((2.0-alpha)/2.0) * \
-                       sp.special.pro_ang1(0,0,gamma,(dist2d/rscale))[0]
-    bad          = np.isnan(schwab)
-    schwab[bad]  = 0.0
+    eta          = np.linspace(0.0,1.0,ntab)           # radial table
+    with np.errstate(invalid='ignore'):
+        table    = (1.0-eta**2)**((2.0-alpha)/2.0) * \
+                       sp.special.pro_ang1(0,0,gamma,eta)[0]
+    table[np.isnan(table)] = 0.0
+    schwab       = np.interp(dist2d/rscale,eta,table,right=0.0) # 0 beyond rscale
     schwab       = schwab / np.sum(schwab)
     return schwab
 
+def kernelcache(key, func):
+    """ return the array func() for key, from the in-memory LRU cache
+    t2v_kernels, the on-disk cache in t2v_cachedir, or by computing it
+    key        tuple describing the kernel (name and geometry)
+    func       function without arguments that computes the array
+            Helper function for tp2vis()
+    """
+    if key in t2v_kernels:                      # memory
+        t2v_kernels.move_to_end(key)
+        return t2v_kernels[key]
+    data  = None
+    fname = None
+    if t2v_cachedir != None:                    # disk
+        fname = os.path.join(t2v_cachedir,
+                   'kern_' + hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+        if os.path.exists(fname):
+            try:
+                data = np.load(fname)
+                print("Using cached kernel %s" % fname)
+            except:
+                data = None
+    if data is None:                            # compute, and save
+        data = func()
+        if fname != None:
+            try:
+                if not os.path.isdir(t2v_cachedir):
+                    os.makedirs(t2v_cachedir)
+                ftmp = fname + '.%d.tmp' % os.getpid()
+                fp = open(ftmp,'wb')
+                np.save(fp,data)
+                fp.close()
+                os.replace(ftmp,fname)          # atomic for parallel runs
+            except Exception as e:
+                print("WARNING: cannot cache kernel in %s: %s" % (t2v_cachedir,e))
+    data.flags.writeable = False                # shared, do not modify
+    t2v_kernels[key] = data
+    while sum([a.nbytes for a in t2v_kernels.values()]) > t2v_cachemem:
+        t2v_kernels.popitem(last=False)         # the least recently used
+    return data
+
+def skelname(key):
+    """ return the name of the cached skeleton MS for key in t2v_cachedir,
+    or None without a cache directory
+    key        tuple describing the MS (pointings, observatory and reference
+               day, spectral setup, nvis)
+            Helper function for tp2vis()
+    """
+    if t2v_cachedir == None:
+        return None
+    return os.path.join(t2v_cachedir,
+               'skel_' + hashlib.sha1(repr(key).encode()).hexdigest() + '.ms')
+
+def skelsave(msname, skel):
+    """ save a copy of msname as the cached skeleton MS skel. It keeps the
+    (empty) DATA column, so it takes as much disk as the output MS
+            Helper function for tp2vis()
+    """
+    try:
+        if not os.path.isdir(t2v_cachedir):
+            os.makedirs(t2v_cachedir)
+        stmp = skel + '.%d.tmp' % os.getpid()
+        shutil.copytree(msname,stmp,symlinks=True)
+        if os.path.isdir(skel):                 # another run was faster
+            shutil.rmtree(stmp)
+        else:
+            os.rename(stmp,skel)
+        print("Cached skeleton MS %s (%.3f GB, see cachepurge())" % (skel,dirsize(skel)/1.0e9))
+    except Exception as e:
+        print("WARNING: cannot cache skeleton MS in %s: %s" % (t2v_cachedir,e))
+
+def dirsize(path):
+    """ return the size [bytes] of the file or directory tree path
+            Helper function for skelsave() and cachepurge()
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for (root,dirs,files) in os.walk(path):
+        for f in files:
+            size = size + os.path.getsize(os.path.join(root,f))
+    return size
+
+def cachepurge(kind='all'):
+    """ remove the cached skeleton MSs ('skel'), kernels ('kern') or both
+    ('all') from t2v_cachedir, which tp2vis() never evicts, and clear the
+    in-memory kernels. Returns the number of bytes freed on disk
+    """
+    if kind in ['kern','all']:
+        t2v_kernels.clear()
+    if t2v_cachedir == None or not os.path.isdir(t2v_cachedir):
+        return 0
+    prefix = {'skel': ['skel_'], 'kern': ['kern_'], 'all': ['skel_','kern_']}[kind]
+    freed  = 0
+    for f in os.listdir(t2v_cachedir):
+        if [p for p in prefix if f.startswith(p)] == []:
+            continue
+        path  = os.path.join(t2v_cachedir,f)
+        freed = freed + dirsize(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path,ignore_errors=True)
+        else:
+            os.remove(path)
+    print("CACHEPURGE: %.3f GB freed in %s" % (freed/1.0e9,t2v_cachedir))
+    return freed
+
+def uvgrid2(nx, ny, dx, dy, rfft=False):
+    """ return the uvdist^2 image [lambda^2] of an nx*ny plane with pixel
+    size dx,dy [rad], on the rfft2 half plane if rfft=True (cached)
+    [notice: x-axis runs vertically]
+            Helper function for tp2vis()
+    """
+    def make():
+        frqx      = np.fft.fftfreq(nx,dx)       # frequency in x
+        if rfft:
+            frqy  = np.fft.rfftfreq(ny,dy)      # half plane for rfft2
+        else:
+            frqy  = np.fft.fftfreq(ny,dy)       # frequency in y
+        vgrd,ugrd = np.meshgrid(frqy,frqx)      # make grids
+        return ugrd**2+vgrd**2                  # uvdist^2 image
+    return kernelcache(('uvgrd2',nx,ny,float(dx),float(dy),bool(rfft)),make)
+
+def schwabft(nx, ny, rfft=False):
+    """ return the FT of Schwab's spheroidal function (alpha=1, m=6, 3 pixels)
+    on an nx*ny plane, the rfft2 half plane if rfft=True (cached)
+            Helper function for tp2vis()
+    """
+    def make():
+        x0        = np.arange(-nx//2,-nx//2+nx) # get nx pix
+        y0        = np.arange(-ny//2,-ny//2+ny) # get ny pix
+        xx,yy     = np.meshgrid(x0,y0,indexing='ij')      # xx[ix][iy]
+        xygrid    = np.sqrt(xx*xx + yy*yy)
+        schwab    = schwab_spheroidal(1.0,6.0,3.0,xygrid) # alpha=1, m=6
+        if rfft:
+            return np.fft.rfft2(np.fft.ifftshift(schwab))
+        return np.fft.fft2(np.fft.ifftshift(schwab))
+    return kernelcache(('schwab_ft',nx,ny,bool(rfft)),make)
+
+def uvsample(nvis, sigma, uvcut2, seed=123, oversample=1.1):
+    """ return (uu,vv) of nvis visibilities [m]: (0,0) first, the rest
+    drawn from a gaussian with sigma [m], all inside uvdist^2 < uvcut2 [m^2]
+    seed       seed for numpy.random.Generator, -1 for a random seed
+    oversample factor on the expected number of draws, so that a single
+    pass almost always gives enough samples inside uvcut2
+            Helper function for tp2vis() and tp2visbl()
+    """
+    rng  = np.random.default_rng(seed if seed >= 0 else None)
+    pin  = 1.0 - np.exp(-uvcut2/(2.0*sigma**2))   # fraction inside uvcut
+    uv   = np.zeros((2,nvis))                   # (0,0) exists already
+    nuv  = 1
+    while nuv < nvis:                           # normally one pass
+        nrest = nvis - nuv
+        ndraw = int(np.ceil(oversample*nrest/pin)) + 16
+        tmp   = rng.normal(scale=sigma,size=(2,ndraw))
+        ok    = tmp[0]**2+tmp[1]**2 < uvcut2    # ok for uvdist<uvcut
+        tmp   = tmp[:,ok][:,:nrest]
+        uv[:,nuv:nuv+tmp.shape[1]] = tmp
+        nuv   = nuv + tmp.shape[1]
+    return uv[0],uv[1]
+
+def autonvgrp(npair, sigma, uvcut2, dbin=None, seed=123, tol=0.1, nvmax=16, nseed=4):
+    """ return the smallest nvgrp (nvis = npair*nvgrp) for which the density
+    of the uvsample() points matches the truncated gaussian they are drawn
+    from within a relative rms of tol, for that and all larger nvgrp up to
+    nvmax, counted in uv cells of dbin x dbin [m]
+    sigma      sigma of the gaussian in uv [m]; tp2vis() draws the samples
+               from the VI beam FT (vi_beamSigFT), so that is the sigma to
+               test, while the TP beam only enters through uvcut2
+    uvcut2     uvdist^2 cutoff [m^2]
+    dbin       uv cell size [m], default sigma/2, fine enough to resolve the
+               footprint (a dish size is coarser than sigma)
+    nvmax      largest nvgrp to try, returned with a warning if tol is not met
+    nseed      the rms error is averaged over the samples of this many seeds,
+               starting at the seed of tp2vis(), so that the choice does not
+               hinge on the shot noise of one draw
+            Helper function for tp2vis()
+    """
+    if dbin == None:
+        dbin  = sigma/2.0
+    uvcut = np.sqrt(uvcut2)
+    ncell = int(np.ceil(uvcut/dbin))
+    edges = np.arange(-ncell,ncell+1)*dbin      # uv cell edges [m]
+    nsub  = 16                                  # expected fraction per cell,
+    sub   = (np.arange(2*ncell*nsub)+0.5)*dbin/nsub - ncell*dbin # on a subgrid
+    dens  = np.exp(-(sub[:,None]**2+sub[None,:]**2)/(2.0*sigma**2))
+    dens[sub[:,None]**2+sub[None,:]**2 >= uvcut2] = 0.0
+    prob  = dens.reshape(2*ncell,nsub,2*ncell,nsub).sum(axis=(1,3))
+    prob  = prob/prob.sum()
+    seeds = [seed+k if seed >= 0 else -1 for k in range(nseed)]
+    errs  = []
+    for nvgrp in range(1,nvmax+1):
+        nvis   = npair*nvgrp
+        expect = (nvis-1)*prob
+        err    = 0.0
+        for sd in seeds:
+            uu,vv  = uvsample(nvis,sigma,uvcut2,sd)
+            count  = np.histogram2d(uu[1:],vv[1:],bins=[edges,edges])[0]
+            err    = err + np.sqrt(np.sum((count-expect)**2)/np.sum(expect**2))
+        errs.append(err/nseed)
+        print("nvgrp=%2d  nvis=%6d  uv density rms error %.4f" % (nvgrp,nvis,errs[-1]))
+    for nvgrp in range(1,nvmax+1):              # below tol from here on
+        if max(errs[nvgrp-1:]) <= tol:
+            return nvgrp
+    print("WARNING: nvgrp=%d does not reach the tolerance %g, using it anyway" % (nvmax,tol))
+    return nvmax
+
+def uvwtile(uu, vv, npnt):
+    """ return the UVW column [3][npnt*nvis] with the same (uu,vv) set
+    for each of the npnt pointings, and w=0, in a single allocation
+            Helper function for tp2vis()
+    """
+    nvis = len(uu)
+    uvw  = np.zeros((3,npnt*nvis))
+    uvw[0].reshape(npnt,nvis)[:] = uu           # rows are views of uvw
+    uvw[1].reshape(npnt,nvis)[:] = vv
+    return uvw
+
+def wtaccum(acc, weight, ddid, fid):
+    """ accumulate the statistics of a chunk of weights per DATA_DESC_ID
+    acc        dict, acc[ddid] = [n, mean, M2, min, max, set of FIELD_IDs]
+    weight     weight[npol][irow] of the chunk
+    ddid,fid   DATA_DESC_ID and FIELD_ID of the rows
+    The chunk mean and M2 are merged with the running ones (Chan et al's
+    parallel form of Welford's algorithm), so one pass gives the std.
+            Helper function for tp2viswt()
+    """
+    for d in np.unique(ddid):
+        sel  = (ddid == d)
+        w    = weight[:,sel].astype(np.float64)
+        n    = w.size
+        mean = w.mean()
+        m2   = ((w-mean)**2).sum()
+        fids = set(np.unique(fid[sel]).tolist())
+        if d not in acc:
+            acc[d] = [n,mean,m2,w.min(),w.max(),fids]
+            continue
+        a     = acc[d]
+        nt    = a[0] + n
+        delta = mean - a[1]
+        a[1]  = a[1] + delta*n/nt
+        a[2]  = a[2] + m2 + delta**2*a[0]*n/nt
+        a[0]  = nt
+        a[3]  = min(a[3],w.min())
+        a[4]  = max(a[4],w.max())
+        a[5].update(fids)
+
+def rowchunks(table, column, nrow):
+    """ return the (startrow,nrow) chunks of at most nrow rows of the open
+    table to read column in; for a variable shape column (e.g. WEIGHT with
+    a different npol per data description) the chunks are split at the
+    runs of DATA_DESC_ID, so that getcol/putcol see a single shape
+            Helper function for wtscan(), wtupdate() and uvmoments()
+    """
+    nrows = table.nrows()
+    if nrows == 0:
+        return []
+    if table.isvarcol(column):
+        runs = fieldruns(table.getcol('DATA_DESC_ID'))
+    else:
+        runs = [(0,nrows,0)]
+    return [(r1,min(nrow,r0+nr-r1)) for (r0,nr,dd) in runs for r1 in range(r0,r0+nr,nrow)]
+
+def wtscan(msname, nrow=1000000):
+    """ return the wtaccum() statistics of the weights of msname, from
+    one pass over chunks of nrow rows; msname can also be a tp2visexport() store
+            Helper function for tp2viswt()
+    """
+    acc   = {}
+    if isvisstore(msname):
+        f = visstore(msname)
+        for g in f.keys():
+            dd  = int(f[g].attrs['ddid'])
+            nr  = f[g]['field_id'].shape[0]
+            for r0 in range(0,nr,nrow):
+                fid = f[g]['field_id'][r0:r0+nrow]
+                wtaccum(acc,f[g]['weight'][r0:r0+nrow].T.astype(np.float64),
+                        np.full(len(fid),dd),fid)
+        visclose(f)
+        return acc
+    tb.open(msname)
+    for (r0,nr) in rowchunks(tb,'WEIGHT',nrow):
+        wtaccum(acc,tb.getcol('WEIGHT',startrow=r0,nrow=nr),
+                    tb.getcol('DATA_DESC_ID',startrow=r0,nrow=nr),
+                    tb.getcol('FIELD_ID',startrow=r0,nrow=nr))
+    tb.close()
+    return acc
+
+def wtupdate(msname, func, nrow=1000000, acc=None):
+    """ rewrite WEIGHT, and SIGMA=1/sqrt(WEIGHT), of msname in one pass
+    over chunks of nrow rows, so only one chunk of each is in memory
+    func       returns the new weight[npol][irow] from func(weight,ddid), with
+               the old weight[npol][irow] and DATA_DESC_ID ddid[irow] of a
+               chunk; it may overwrite weight
+    acc        if given, the wtaccum() statistics of the new weights are
+               accumulated in this dict
+    Returns the number of rows
+            Helper function for tp2vis() and tp2viswt()
+    """
+    tb.open(msname,nomodify=False)
+    nrows = tb.nrows()
+    for (r0,nr) in rowchunks(tb,'WEIGHT',nrow):
+        weight = tb.getcol('WEIGHT',startrow=r0,nrow=nr)
+        ddid   = tb.getcol('DATA_DESC_ID',startrow=r0,nrow=nr)
+        weight = func(weight,ddid)
+        tb.putcol('WEIGHT',weight,startrow=r0,nrow=nr)
+        if acc is not None:
+            wtaccum(acc,weight,ddid,tb.getcol('FIELD_ID',startrow=r0,nrow=nr))
+        np.sqrt(weight,out=weight)              # SIGMA, in place
+        np.reciprocal(weight,out=weight)
+        tb.putcol('SIGMA',weight,startrow=r0,nrow=nr)
+    tb.close()
+    return nrows
+
+def fixtimes(msname, dt=1.0, nrow=1000000):
+    """ give every row of msname its own time stamp [bug028]: TIME and
+    TIME_CENTROID become t0 + dt*irow, with t0 the TIME of the first row,
+    written in chunks of nrow rows. Also works on existing TP MSs.
+    Returns the number of rows
+            Helper function for tp2vis()
+    """
+    tb.open(msname,nomodify=False)
+    nrows = tb.nrows()
+    if nrows > 0:
+        t0 = tb.getcell('TIME',0)
+    for r0 in range(0,nrows,nrow):
+        nr    = min(nrow,nrows-r0)
+        times = t0 + dt*np.arange(r0,r0+nr,dtype=np.float64)
+        tb.putcol('TIME',times,startrow=r0,nrow=nr)
+        tb.putcol('TIME_CENTROID',times,startrow=r0,nrow=nr)
+    tb.close()
+    return nrows
+
+def mskey(msname):
+    """ return a cache key for msname, which changes when one of the
+    table files of the MS is modified
+            Helper function for uvmoments() and ampspectrum()
+    """
+    if os.path.isfile(msname):                  # HDF5 store
+        return (os.path.abspath(msname),os.path.getmtime(msname))
+    mtime = max([e.stat().st_mtime for e in os.scandir(msname) if e.is_file()])
+    return (os.path.abspath(msname),mtime)
+
+def ampspectrum(msname, maxmem=0.25):
+    """ return (freq, asum): the channel frequencies [Hz] of the first
+    (lowest) data description that has rows in msname and the amplitudes
+    of DATA summed over those rows and polarizations, per channel. The rows are read in chunks
+    of at most maxmem [GB], and the result is cached in t2v_spectra.
+    For a tp2visexport() store the data are read in blocks of channels.
+            Helper function for tp2vispl()
+    """
+    key   = mskey(msname)
+    if key in t2v_spectra:
+        return t2v_spectra[key]
+
+    if isvisstore(msname):
+        f     = visstore(msname)
+        g     = f[sorted(f.keys(),key=lambda k: int(f[k].attrs['ddid']))[0]]
+        freq  = g['chan_freq'][:]
+        (nr,nchan,npol) = g['data'].shape
+        cblk  = g['data'].chunks[1]             # channels per chunk
+        nrow  = max(1,int(maxmem*1.0e9/(8*npol*cblk)))
+        asum  = np.zeros(nchan)
+        for c0 in range(0,nchan,cblk):
+            for r0 in range(0,nr,nrow):
+                data = g['data'][r0:r0+nrow,c0:c0+cblk,:]    # (row,chan,pol)
+                asum[c0:c0+cblk] += np.abs(data).sum(axis=(0,2))
+                del data
+        visclose(f)
+        t2v_spectra[key] = (freq,asum)
+        return (freq,asum)
+
+    tb.open(msname)
+    ddid  = tb.getcol('DATA_DESC_ID')
+    if len(ddid) == 0:
+        tb.close()
+        raise Exception("ERROR: no rows in %s" % msname)
+    d0    = int(ddid.min())                     # first data description with rows
+    rows  = np.nonzero(ddid == d0)[0]
+    tb.close()
+    tb.open(msname + '/DATA_DESCRIPTION')
+    spwid = tb.getcol('SPECTRAL_WINDOW_ID')[d0]
+    tb.close()
+    tb.open(msname + '/SPECTRAL_WINDOW')
+    freq  = tb.getcell('CHAN_FREQ',spwid)       # [Hz]
+    tb.close()
+
+    tb.open(msname)
+    asum  = np.zeros(len(freq))
+    npol  = tb.getcell('DATA',int(rows[0])).shape[0]
+    nrow  = max(1,int(maxmem*1.0e9/(8*npol*len(freq))))
+    if tb.isvarcol('DATA'):                     # other shapes: only the runs of d0
+        chunks = [(r1,min(nrow,r0+nr-r1)) for (r0,nr,dd) in fieldruns(ddid) if dd == d0
+                  for r1 in range(r0,r0+nr,nrow)]
+    else:                                       # row chunks, d0 selected in memory
+        chunks = [(r0,min(nrow,rows[-1]+1-r0)) for r0 in range(rows[0],rows[-1]+1,nrow)]
+    for (r0,nr) in chunks:
+        sel  = ddid[r0:r0+nr] == d0
+        if not sel.any():
+            continue
+        data = tb.getcol('DATA',startrow=int(r0),nrow=int(nr))   # (pol,chan,row)
+        asum += np.abs(data[:,:,sel]).sum(axis=(0,2))
+        del data
+    tb.close()
+    t2v_spectra[key] = (freq,asum)
+    return (freq,asum)
+
+def uvmoments(msname, nrow=1000000):
+    """ return the natural weighted uv moments (sumw, sumw*u^2, sumw*u*v, sumw*v^2)
+    of msname over all rows and channels, u,v in [lambda]. They are sums,
+    so the moments of several MSs add up. Cached in t2v_uvmom until
+    one of the table files of the MS is modified (e.g. new weights).
+            Helper function for tp2viswt()
+    """
+    key   = mskey(msname)
+    if key in t2v_uvmom:
+        print("Using cached uv moments of %s" % msname)
+        return t2v_uvmom[key]
+
+    cms   = qa.constants('c')['value']          # speed of light in m/s
+    tb.open(msname + '/SPECTRAL_WINDOW')        # sum (1/lambda)^2 per spw
+    nspw  = tb.nrows()
+    nch   = np.array([len(tb.getcell('CHAN_FREQ',i)) for i in range(nspw)])
+    f2    = np.array([np.sum((tb.getcell('CHAN_FREQ',i)/cms)**2) for i in range(nspw)])
+    tb.close()
+    tb.open(msname + '/DATA_DESCRIPTION')       # ddid -> spw
+    spwid = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+    nch,f2 = nch[spwid],f2[spwid]               # per ddid
+
+    mom   = np.zeros(4)
+    tb.open(msname)
+    for (r0,nr) in rowchunks(tb,'WEIGHT',nrow):
+        uvw  = tb.getcol('UVW',startrow=r0,nrow=nr)
+        w    = tb.getcol('WEIGHT',startrow=r0,nrow=nr).sum(axis=0)
+        w[tb.getcol('FLAG_ROW',startrow=r0,nrow=nr)] = 0.0
+        dd   = tb.getcol('DATA_DESC_ID',startrow=r0,nrow=nr)
+        wf2  = w*f2[dd]
+        mom += [np.sum(w*nch[dd]), np.sum(wf2*uvw[0]**2),
+                np.sum(wf2*uvw[0]*uvw[1]), np.sum(wf2*uvw[1]**2)]
+    tb.close()
+    t2v_uvmom[key] = mom
+    return mom
+
+def uvbeam(mslist):
+    """ return (omega, bmaj, bmin) [strad, rad, rad] of the gaussian that has
+    the same curvature at the peak as the natural weighted PSF of the MS(s):
+    the image covariance is inverse(<uu,uv,vv>)/(4 pi^2), so that
+    omega = 1/(2 pi sqrt(det <uu,uv,vv>)). This is exact for the gaussian
+    uv distribution of the TP visibilities.
+            Helper function for tp2viswt()
+    """
+    if type(mslist) != type([]): mslist = [mslist]
+    mom   = np.sum([uvmoments(ims) for ims in mslist],axis=0)
+    cov   = np.array([[mom[1],mom[2]],[mom[2],mom[3]]]) / mom[0]   # [lambda^2]
+    sig2  = 1.0/(4.0*np.pi**2*np.linalg.eigvalsh(cov))             # [rad^2]
+    stof  = 2.0*np.sqrt(2.0*np.log(2.0))        # FWHM=stof*sigma
+    omega = 1.0/(2.0*np.pi*np.sqrt(np.linalg.det(cov)))
+    return (omega, stof*np.sqrt(sig2.max()), stof*np.sqrt(sig2.min()))
+
+def wtconst(value):
+    """ return a wtupdate() function that sets all weights to value
+            Helper function for tp2vis() and tp2viswt()
+    """
+    def func(weight, ddid):
+        weight[:,:] = value
+        return weight
+    return func
+
+def memavail():
+    """ return the available memory [bytes], or None if it cannot be found
+            Helper function for tp2vis()
+    """
+    try:
+        fp = open('/proc/meminfo')              # linux
+        lines = fp.readlines()
+        fp.close()
+        for line in lines:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    except:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except:
+        return None
+
+def chanblock(nx, ny, nchan, nblock=0, memfrac=0.25, rfft=False, maxmem=None, chanbytes=None,
+              schwab=False):
+    """ return the number of channels to deconvolve in one block
+    nx,ny      plane size [pixels]
+    nchan      number of channels in the cube
+    nblock     >0: use this (clipped to nchan)
+               0:  use maxmem, or else a fraction memfrac of the available memory
+    rfft       True if the rfft2 path of rdeconvolve() is used
+    maxmem     memory budget for one block [bytes]
+    chanbytes  memory needed per channel [bytes], if not that of the
+               deconvolution of an nx*ny plane
+    schwab     True if the beam includes the (complex) Schwab kernel FT
+            Helper function for tp2vis()
+    """
+    if nblock > 0:
+        return int(min(nblock,nchan))
+    # per pixel and channel, what is alive at the peak (the inverse FFT):
+    # deconvolve(): image, beamFT (complex with schwab), imageFT, imageFTdec,
+    #   the intermediate and the output of ifft2, whose real part is copied
+    #   by putchunk only after the intermediate is gone
+    # rdeconvolve(): image, half plane FT, the half plane intermediate and
+    #   output of irfft2, and the inner uv arrays and the getchunk copy
+    nbytes = 8 + (16 if schwab else 8) + 16 + 16 + 16 + 16
+    if rfft:
+        nbytes = 8 + 8 + 8 + 8 + 8
+    if maxmem != None:
+        avail = maxmem
+    else:
+        avail = memavail()
+        if avail == None:
+            return 1
+        avail = memfrac * avail
+    if chanbytes == None:
+        chanbytes = nbytes*nx*ny
+    nblock = int(avail / chanbytes)
+    if nblock < 1:
+        print("WARNING: memory budget %.3g GB too small for one channel of %dx%d" %
+              (avail/1e9,nx,ny))
+    return int(max(1,min(nblock,nchan)))
+
+def peakmem():
+    """ return the peak resident memory [bytes] of this process and of its
+    largest (finished) child process, over their whole lifetime so far,
+    not over a part of it
+            Helper function for tp2vis()
+    """
+    try:
+        import resource
+        self  = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        child = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        scale = 1 if sys.platform == 'darwin' else 1024 # bytes on mac, kB on linux
+        return self*scale, child*scale
+    except:
+        return None, None
+
+def tukeywin(mask, nwin):
+    """ return a Tukey window of width nwin [pixels] for a 2d mask plane,
+    tapering from the blanked pixels and the edges of the plane
+            Helper function for tp2vis()
+    """
+    nnx       = mask.shape[0]
+    nny       = mask.shape[1]
+    maskexp   = np.zeros([nnx+2,nny+2])       # add 1pix each edge
+    maskexp[1:nnx+1,1:nny+1] = mask           # edge = 0 (blank)
+    dist = distance_transform_edt(maskexp)-1. # dist. from blanks
+    dist[dist<0]     = 0                      # outside/blanks=0
+    dist[dist>nwin]  = nwin                   # deep inside=nwin
+    dist      = dist/nwin                     # normalize to [0,1]
+    dist      = dist[1:nnx+1,1:nny+1]         # trim the expansion
+    return 0.5*(1.0-np.cos(np.pi*dist))       # Tukey window
+
+def tukeycache(mask, nwin, cache, ncache=8):
+    """ return tukeywin(mask,nwin), reused from cache for a mask plane
+    seen before (usually the mask is the same in all channels)
+    cache      OrderedDict of windows by the hash of the mask plane,
+               the last ncache are kept
+            Helper function for tp2vis()
+    """
+    key = (mask.shape,hashlib.sha1(np.packbits(mask).tobytes()).hexdigest())
+    if key in cache:
+        cache.move_to_end(key)
+    else:
+        cache[key] = tukeywin(mask,nwin)
+        while len(cache) > ncache:
+            cache.popitem(last=False)
+    return cache[key]
+
+def deconvolve(image, uvgrd2, uvcut, sigft, schwab_ft=None):
+    """ deconvolve a block of channel planes by the gaussian TP beam
+    image      image[ix][iy][iz] in Jy/pixel, iz runs over the block
+    uvgrd2     uvdist^2 image of a plane [lambda^2]
+    uvcut      cutoff uv distance [lambda], outer uv is set to zero
+    sigft      sigma of the TP beam in fourier [lambda], one per channel
+    schwab_ft  FT of the gridding kernel to include in the beam (optional)
+    Returns the deconvolved planes, same shape as image
+            Helper function for tp2vis()
+    """
+    sigft      = np.asarray(sigft,dtype=float)
+    beamFT     = np.exp(-uvgrd2[:,:,None]/(2.0*sigft[None,None,:]**2))
+    if schwab_ft is not None:
+        beamFT = beamFT * schwab_ft[:,:,None]     # Gauss * Schwab
+    imageFT          = np.fft.fft2(image,axes=(0,1))
+    imageFTdec       = imageFT.copy()
+    idx0             = (uvgrd2   > (uvcut**2))    # idx of outer uv
+    idx1             = np.logical_not(idx0)       # idx of inner uv
+    imageFTdec[idx1] = imageFT[idx1]/beamFT[idx1] # just for inner uv
+    imageFTdec[idx0] = 0.0                        # set outer uv zero
+    return np.real(np.fft.ifft2(imageFTdec,axes=(0,1)))
+
+def rdeconvolve(image, inner, uvin2, sigft, schwab_in=None):
+    """ deconvolve a block of channel planes by the gaussian TP beam,
+    real-to-complex version of deconvolve()
+    image      image[ix][iy][iz] in Jy/pixel, iz runs over the block
+    inner      (ix,iy) indices of the inner uv cells on the rfft2 grid,
+               computed once per cube, all other uv are set to zero
+    uvin2      uvdist^2 of the inner uv cells [lambda^2]
+    sigft      sigma of the TP beam in fourier [lambda], one per channel
+    schwab_in  rfft2 of the gridding kernel in the inner uv cells (optional)
+    Only the half plane of the rfft2 is stored, and the beam is only
+    evaluated on the inner uv, which roughly halves memory and FFT time.
+    Returns the deconvolved planes, same shape as image
+            Helper function for tp2vis()
+    """
+    nx,ny      = image.shape[0],image.shape[1]
+    sigft      = np.asarray(sigft,dtype=float)
+    beamFT     = np.exp(-uvin2[:,None]/(2.0*sigft[None,:]**2))
+    if schwab_in is not None:
+        beamFT = beamFT * schwab_in[:,None]       # Gauss * Schwab
+    imageFT    = np.fft.rfft2(image,axes=(0,1))   # imageFT[ix][iy<=ny/2][iz]
+    innerFT    = imageFT[inner]                   # innerFT[iuv][iz]
+    innerFT   /= beamFT                           # just for inner uv
+    imageFT[...]   = 0.0                          # set outer uv zero
+    imageFT[inner] = innerFT
+    del beamFT,innerFT
+    return np.fft.irfft2(imageFT,s=(nx,ny),axes=(0,1))
+
+def deconvplanes(image, sigft, kern):
+    """ deconvolve a block of channel planes with deconvolve() or,
+    if kern holds the inner uv indices, with rdeconvolve()
+    kern       dict with the keyword arguments for either of them
+            Helper function for tp2vis()
+    """
+    if 'inner' in kern:
+        return rdeconvolve(image, sigft=sigft, **kern)
+    return deconvolve(image, sigft=sigft, **kern)
+
+def deconvworker(job):
+    """ deconvolve one block of channels from the staged input cube
+    into the staged output cube, with the kernel read from its staged
+    (.npy) files
+            Helper function for deconvpool()
+    """
+    (decin,decout,kfiles,kvals,iz0,iz1,sigft) = job
+    kern    = dict(kvals)
+    for (name,f) in kfiles.items():
+        kern[name] = np.load(f,mmap_mode='r')
+    if 'inner' in kern:
+        kern['inner'] = tuple(kern['inner'])      # (ix,iy) index arrays
+    cubein  = np.load(decin, mmap_mode='r')
+    cubeout = np.load(decout,mmap_mode='r+')
+    cubeout[:,:,iz0:iz1+1] = deconvplanes(cubein[:,:,iz0:iz1+1],sigft,kern)
+    cubeout.flush()
+    del cubein,cubeout,kern
+    return iz0
+
+def deconvpool(decin, decout, blocks, kern, nproc=2, deckern='tmp_deckern_'):
+    """ deconvolve blocks of channels on a pool of nproc processes
+    decin      staged (.npy) input cube, image[ix][iy][iz] in Jy/pixel
+    decout     staged (.npy) output cube, same shape, float64
+    blocks     list of (iz0,iz1,sigft) for each block of channels
+    kern       deconvolution kernel, see deconvplanes()
+    deckern    prefix of the staged (.npy) kernel arrays, removed at the end
+    The workers are spawned, not forked, and read the cubes and the
+    kernel as memory maps, so nothing of the parent is copied into them.
+    Each block is handled by deconvplanes() exactly as in the serial
+    path, so the result is bit-identical to it.
+            Helper function for tp2vis()
+    """
+    import multiprocessing as mp
+
+    kfiles = {}
+    kvals  = {}
+    try:
+        for (name,k) in kern.items():
+            if k is None or np.isscalar(k):
+                kvals[name] = k
+                continue
+            kfiles[name] = deckern + name + '.npy'
+            np.save(kfiles[name],np.asarray(k))   # 'inner' as a (2,n) int array
+        jobs  = [(decin,decout,kfiles,kvals,iz0,iz1,sigft) for (iz0,iz1,sigft) in blocks]
+        nproc = min(nproc,len(blocks))
+        print("Deconvolving %d blocks on %d processes" % (len(blocks),nproc))
+        pool  = mp.get_context('spawn').Pool(nproc)
+        try:
+            pool.map(deconvworker,jobs,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for f in kfiles.values():                 # also after an error
+            if os.path.exists(f):
+                os.remove(f)
+
+
+def fieldruns(fid):
+    """ return a list of (startrow,nrow,fieldid) for the runs of
+    consecutive rows with the same FIELD_ID (or any other column)
+            Helper function for nppredict() and ampspectrum()
+    """
+    fid   = np.asarray(fid)
+    edges = np.concatenate(([0],np.nonzero(np.diff(fid))[0]+1,[len(fid)]))
+    return [(int(r0),int(r1-r0),int(fid[r0])) for (r0,r1) in zip(edges[:-1],edges[1:])]
+
+def pbvisgrid(image, ptgpix, dxy, sig2, hw, du, nu):
+    """ fourier transform of a block of channel planes times the gaussian
+    primary beam of one pointing, on the (2*nu+1)^2 uv cells around (0,0)
+    image      image[ix][iy][iz] in Jy/pixel, iz runs over the block
+    ptgpix     (x,y) pixel of the pointing (phase center)
+    dxy        (cdelt1,cdelt2) pixel increments [rad], with sign
+    sig2       beam sigma^2 [rad^2], one per channel
+    hw         half width of the beam window [pixels]
+    du         uv cell size [lambda]
+    nu         number of uv cells on each side of (0,0)
+    Only the few uv cells inside the TP uvcut are needed, so instead of an
+    FFT of a zero padded plane this is a direct transform on those cells,
+    done as two matrix products per plane. The phase center is the pointing
+    pixel (ix,iy) nearest to the pointing, which keeps it smooth.
+    Returns gridFT[iz][iu][iv]
+            Helper function for nppredict()
+    """
+    nx,ny,nb = image.shape
+    ix,iy  = int(round(ptgpix[0])),int(round(ptgpix[1]))
+    xw     = np.arange(max(0,ix-hw),min(nx,ix+hw+1))
+    yw     = np.arange(max(0,iy-hw),min(ny,iy+hw+1))
+    l2     = ((xw-ptgpix[0])*dxy[0])**2
+    m2     = ((yw-ptgpix[1])*dxy[1])**2
+    beam   = np.exp(-(l2[:,None,None]+m2[None,:,None])/(2.0*sig2[None,None,:]))
+    pbimg  = (image[np.ix_(xw,yw)] * beam).transpose(2,0,1)  # pbimg[iz][ix][iy]
+    uc     = np.arange(-nu,nu+1)*du               # uv cells [lambda]
+    eu     = np.exp(-2j*np.pi*np.outer(uc,(xw-ix)*dxy[0]))
+    ev     = np.exp(-2j*np.pi*np.outer(uc,(yw-iy)*dxy[1]))
+    return np.matmul(np.matmul(eu,pbimg),ev.T)
+
+def pbvisdegrid(gridFT, ptgpix, dxy, du, uu, vv, fz):
+    """ bilinear interpolation of pbvisgrid() at the (u,v) samples
+    uu,vv      (u,v) of the rows [m]
+    fz         1/lambda of the channels [1/m]
+    Returns vis[irow][iz] [Jy]
+            Helper function for nppredict()
+    """
+    nu     = gridFT.shape[1]//2
+    ix,iy  = int(round(ptgpix[0])),int(round(ptgpix[1]))
+    ul     = uu[:,None]*fz[None,:]                # u [lambda]
+    vl     = vv[:,None]*fz[None,:]
+    a      = ul/du + nu                           # position on the grid
+    b      = vl/du + nu
+    a0     = np.clip(np.floor(a).astype(int),0,2*nu-1)
+    b0     = np.clip(np.floor(b).astype(int),0,2*nu-1)
+    fa,fb  = a-a0,b-b0
+    iz     = np.arange(gridFT.shape[0])[None,:]
+    vis    = (1-fa)*(1-fb)*gridFT[iz,a0,b0]   + fa*(1-fb)*gridFT[iz,a0+1,b0] + \
+             (1-fa)*   fb *gridFT[iz,a0,b0+1] + fa*   fb *gridFT[iz,a0+1,b0+1]
+    # shift the phase center from pixel (ix,iy) to the pointing
+    vis   *= np.exp(-2j*np.pi*(ul*(ix-ptgpix[0])*dxy[0] + vl*(iy-ptgpix[1])*dxy[1]))
+    return vis
+
+def nppredict(msname, imagename, beamsigma, reffreq, pad=8, nsig=5.0, nblock=0, compare=False, order='0123'):
+    """ predict the DATA column of msname from the model imagename with
+    a gaussian primary beam, a numpy replacement for sm.predict
+    msname     MS with UVW and FIELD_ID filled in (e.g. after sm.observemany)
+    imagename  model cube [ra,dec,pol,freq] in Jy/pixel, same channels as msname
+    beamsigma  sigma of the gaussian primary beam [rad] at reffreq [Hz]
+    pad        oversampling of the uv cells, relative to the beam window size
+    nsig       half width of the beam window [beam sigma]
+    nblock     number of channels per block [=0 to pick from the available memory]
+    compare    if True the DATA column is not written, but compared with
+               the prediction, and (rms of DATA, rms of the difference) is returned
+    order      axes order of imagename, from axorder(), if not [ra,dec,pol,freq]
+    Per block of channels and per run of rows of a field, the beam window
+    is transformed once to the uv cells inside the largest uvdist, and the
+    visibilities are interpolated from them at all (u,v,channel).
+    DATA is written in the same row chunks.
+            Helper function for tp2vis()
+    """
+    cms    = qa.constants('c')['value']           # speed of light in m/s
+
+    # Channel frequencies and field (phase) centers
+    tb.open(msname + '/SPECTRAL_WINDOW')
+    freq   = tb.getcol('CHAN_FREQ')[:,0]          # [Hz]
+    tb.close()
+    tb.open(msname + '/FIELD')
+    phdir  = tb.getcol('PHASE_DIR')[:,0,:]        # phdir[radec][ifield] [rad]
+    tb.close()
+
+    perm   = [int(c) for c in order]
+    ia.open(imagename)
+    shape  = ia.shape()
+    nchan  = shape[perm[3]]
+    if nchan != len(freq):
+        ia.close()
+        raise Exception("ERROR: %d channels in %s, %d in %s" % (nchan,imagename,len(freq),msname))
+    nx,ny  = shape[perm[0]],shape[perm[1]]
+    cs     = ia.coordsys()
+    if order != '0123':
+        cs.transpose(perm)                        # to [ra,dec,pol,freq]
+    units  = cs.units()[0:2]                      # direction units, e.g. deg
+    dxy    = np.array([qa.convert({'value':d,'unit':u},'rad')['value'] for (d,u) in
+                       zip(cs.increment()['numeric'][0:2],units)]) # [rad], with sign
+    world  = cs.referencevalue()['numeric']
+    ptgpix = []
+    for k in range(phdir.shape[1]):               # pointing in the axis units
+        world[0:2] = [qa.convert({'value':p,'unit':'rad'},u)['value'] for (p,u) in
+                      zip(phdir[:,k],units)]
+        ptgpix.append(cs.topixel(world)['numeric'][0:2])
+    cs.done()
+
+    tb.open(msname,nomodify=compare)
+    runs   = fieldruns(tb.getcol('FIELD_ID'))
+    ncorr  = tb.getcell('DATA',0).shape[0]
+    uvw    = tb.getcol('UVW')
+    uvmax  = np.abs(uvw[0:2]).max()*freq.max()/cms   # [lambda]
+    del uvw
+
+    # Beam window (widest beam at the lowest freq) and uv cells
+    sigma  = beamsigma*reffreq/freq               # beam sigma per channel [rad]
+    hw     = int(np.ceil(nsig*sigma.max()/np.abs(dxy).min()))
+    du     = 1.0/(pad*(2*hw+1)*np.abs(dxy).min()) # uv cell [lambda]
+    nu     = int(np.ceil(uvmax/du)) + 1
+    print("nppredict: window %d pixels, %d x %d uv cells" % (2*hw+1,2*nu+1,2*nu+1))
+
+    sumref = 0.0
+    sumdif = 0.0
+    ndata  = 0
+    # per channel: the image plane, the uv grid and the matmul in between,
+    # and the beam and beam*image windows
+    nw     = 2*hw+1
+    ng     = 2*nu+1
+    nblk   = chanblock(nx,ny,nchan,nblock,chanbytes=8*nx*ny+16*ng*ng+16*ng*nw+24*nw*nw)
+    for iz0 in range(0,nchan,nblk):
+        iz1    = min(iz0+nblk,nchan) - 1          # last chan in block
+        image  = axchunk(ia,order,iz0,iz1)[:,:,0,:]
+        sig2   = sigma[iz0:iz1+1]**2
+        fz     = freq[iz0:iz1+1]/cms              # 1/lambda [1/m]
+        kft    = -1
+        for (r0,nr,k) in runs:
+            if k != kft:                          # same field as last run?
+                gridFT = pbvisgrid(image,ptgpix[k],dxy,sig2,hw,du,nu)
+                kft    = k
+            uvw    = tb.getcol('UVW',startrow=r0,nrow=nr)
+            vis    = pbvisdegrid(gridFT,ptgpix[k],dxy,du,uvw[0],uvw[1],fz)
+            vis    = np.repeat(vis.T[None,:,:],ncorr,axis=0) # vis[icorr][iz][irow]
+            blc,trc = [0,iz0],[ncorr-1,iz1]
+            if compare:
+                data   = tb.getcolslice('DATA',blc,trc,[1,1],startrow=r0,nrow=nr)
+                sumref = sumref + np.sum(np.abs(data)**2)
+                sumdif = sumdif + np.sum(np.abs(vis-data)**2)
+                ndata  = ndata + data.size
+            else:
+                tb.putcolslice('DATA',vis,blc,trc,[1,1],startrow=r0,nrow=nr)
+        del image
+    tb.close()
+    ia.close()
+
+    if compare:
+        return (np.sqrt(sumref/ndata),np.sqrt(sumdif/ndata))
+
 
 ## ==========================================================
 ## TP2VIS: main function to convert TP cube into visibilities
 ## ==========================================================
 
-def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, winpix=0):
+def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, winpix=0,
+           nblock=0, nproc=1, rfft=False, maxmem=None, predict='sm', cache=False, nvtol=0.1,
+           export=None):
     """
     Required:
     ---------
@@ -319,10 +1254,38 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
               See also tp2viswt(mode=3)
     nvgrp     Number of visibility group (nvis = 1035*nvgrp)
               The number of antenna is hardcoded as 46
+              'auto': the smallest nvgrp for which the sampled uv density
+              matches the VI beam's Fourier footprint it is drawn from within
+              nvtol, also for all larger nvgrp (see autonvgrp())
+    nvtol     Relative rms tolerance of the uv density for nvgrp='auto',
+              in uv cells of half the footprint sigma, averaged over 4 seeds
     deconv    Use deconvolution as input model? (True)
               When you have a Jy/pixel map, you want to set deconv=False
     winpix    Width of the Tukey window to reduce aliasing [=0 for no window],
               Number of pixels from each edge
+    nblock    Number of channels deconvolved together in one block
+              [=0 to pick it from the available memory]
+    nproc     Number of processes to deconvolve the blocks of channels with.
+              The result is identical to the serial (nproc=1) path.
+    rfft      Use the real-to-complex rfft2/irfft2 deconvolution, which
+              roughly halves the memory and FFT time per plane
+    maxmem    Memory budget [GB] for the deconvolution. With nblock=0 the
+              channel block size is picked to fit it, planes are streamed
+              from and to disk block by block, and the peak memory is reported.
+    predict   How to fill the visibilities from the (deconvolved) cube:
+              'sm'     CASA's sm.predict (default)
+              'numpy'  nppredict(), a direct numpy prediction with the gaussian
+                       VI primary beam, much faster
+              'check'  sm.predict, then report the rms difference with nppredict().
+                       Expect a few percent unless use_vp=True, as the default
+                       ALMA voltage pattern of sm.predict is not a gaussian.
+    cache     Keep the empty (skeleton) MS in t2v_cachedir, and clone it
+              in later runs with the same pointings, spectral setup and nvgrp,
+              instead of running the simulator again (t2v_cachedir must be set).
+              Each skeleton keeps an empty DATA column, as large as outfile;
+              they are never evicted, remove them with cachepurge('skel')
+    export    Also export the visibilities to this Zarr (.zarr) or HDF5 (.h5)
+              store with tp2visexport(), for tp2viswt(mode='stat') and tp2vispl()
     Some Technical Background:
     --------------------------
     There are 46 virtual antennas, each pointing will be visited 'nvgrp' times before
@@ -357,20 +1320,20 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
         print("Cannot overwrite",outfile)
         return
 
-    # Ensure RA-DEC-POL-FREQ axis order (CASA simulator needs it)
-    if axinorder(infile):                       # if 4 axes in order
-        imagename = infile                      # use original file
-        delimage  = False
-    else:                                       # if not, rearrange
-        imagename = arangeax(infile)            # and use re-aranged data
-        delimage  = True        
+    # RA-DEC-POL-FREQ axis order (CASA simulator needs it). Other orders
+    # are read through a transposed view; only sm.predict of a cube that
+    # is not deconvolved needs a re-aranged copy
+    imagename = infile
+    order     = axorder(infile)
+    if order != '0123':
+        print("Reading axes in transpose order=%s" % order)
 
     # Parameters from TP cube header
     # ==============================
 
     cms    = qa.constants('c')['value']         # speed of light in m/s
 
-    h0         = imhead(imagename,mode='list')
+    h0         = axhead(imhead(imagename,mode='list'),order)
     cb_shape   = h0['shape']                    # cube shape
     cb_nx      = h0['shape'][0]                 # num of pixels, RA
     cb_ny      = h0['shape'][1]                 #              , DEC
@@ -436,6 +1399,10 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
             print("ERROR: unit should be 'Jy/pixel' when deconv=False",cb_bunit)
             return
 
+    if predict not in ['sm','numpy','check']:
+        print("ERROR: predict should be 'sm', 'numpy' or 'check'",predict)
+        return
+
     # Constants
     apr    = qa.convert('1.0rad','arcsec')['value'] # arcsec per radian
     cbm    = np.pi/(4.0*np.log(2.0))                # beamarea=cbm*bmaj*bmin
@@ -452,82 +1419,123 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
     uvcut  = np.minimum(maxuv/cb_refwave,uvcut) # compare with maxuv
     print("UVCUT:", uvcut/1000.0,"kLambda")
 
-    # Generate uvdist^2 image [notice: x-axis runs vertically] 
-    frqx      = np.fft.fftfreq(cb_nx,cb_dx)     # frequency in x
-    frqy      = np.fft.fftfreq(cb_ny,cb_dy)     # frequency in y
-    vgrd,ugrd = np.meshgrid(frqy,frqx)          # make grids
-    uvgrd2    = ugrd**2+vgrd**2                 # uvdist^2 image
-
-    del frqx,frqy,vgrd,ugrd
-
-
     # Open TP cube (@todo:  this can go inside the if deconv)
     ia.open(imagename)
 
     # Output deconvolved cube
     if deconv:
+        # Generate uvdist^2 image [notice: x-axis runs vertically] 
+        uvgrd2    = uvgrid2(cb_nx,cb_ny,cb_dx,cb_dy,rfft)
+
         dd = ''.join(re.findall('[0-9]',str(datetime.datetime.now())))
         imagedecname = 'tmp_imagedec_' + dd + '.im'
-        ia2 = ia.newimagefromimage(imagename,imagedecname,overwrite=True)
+        if order == '0123':
+            ia2 = ia.newimagefromimage(imagename,imagedecname,overwrite=True)
+        else:                                   # written in RA-DEC-POL-FREQ order
+            ia2 = imlike(imagedecname,imagename,order=order)
 
         if use_schwab:
             print("Using Schwab's spheroidal function in TP deconvolution")
             # Schwab's spheroidal function [pixel unit]
-            # @todo  make sure we can use /, or do we need // in python3
-            #        make sure odd numbers work
-            x0        = np.arange(-cb_nx//2,-cb_nx//2+cb_nx)  # get cb_nx pix
-            y0        = np.arange(-cb_ny//2,-cb_ny//2+cb_ny)  # get cb_ny pix
-            xx,yy     = np.meshgrid(x0,y0)
-            xygrid    = np.sqrt(xx*xx + yy*yy)
-            schwab    = schwab_spheroidal(1.0,6.0,3.0,xygrid) # alpha=1, m=6
-            schwab_ft = np.fft.fft2(np.fft.ifftshift(schwab))
-
-            del x0,y0,xx,yy,xygrid,schwab
-
-        # Loop over channels
-        print("Deconvolution loop starts")
-        for iz in range(cb_nchan):
-
-            # Beam in Fourier domain
-            freq      = cb_fstart+cb_fwidth*(0.5+iz)      # chan cen freq [GHz]
-            beamSigFT = tp_beamSigFT * freq/cb_reffreq
-            beamFT    = np.exp(-uvgrd2/(2.0*beamSigFT**2))
+            schwab_ft = schwabft(cb_nx,cb_ny,rfft)
+        else:
+            schwab_ft = None
+
+        # Deconvolution kernel
+        if rfft:
+            inner     = np.nonzero(uvgrd2 <= uvcut**2)    # inner uv, once
+            kern      = {'inner': inner, 'uvin2': uvgrd2[inner]}
             if use_schwab:
-                beamFT    = beamFT * schwab_ft            # Gauss * Schwab
-
-            # Channel image to be deconvolved
-            image     = ia.getchunk([-1,-1,-1,iz],[-1,-1,-1,iz])
-            image     = image[:,:,0,0]                    # image[ix][iy][0][0]
-            image     = image / nppb                      # scale to Jy/pixel
-
-            # Apply Tukey window
-            if winpix > 0:
-                nwin      = winpix
-                mask      = ia.getchunk([-1,-1,-1,iz],[-1,-1,-1,iz],getmask=True)
-                mask      = mask[:,:,0,0]                 # mask[ix][iy][0,0]
-                nnx       = mask.shape[0]
-                nny       = mask.shape[1]
-                maskexp   = np.zeros([nnx+2,nny+2])       # add 1pix each edge
-                maskexp[1:nnx+1,1:nny+1] = mask           # edge = 0 (blank)
-                dist = distance_transform_edt(maskexp)-1. # dist. from blanks
-                dist[dist<0]     = 0                      # outside/blanks=0
-                dist[dist>nwin]  = nwin                   # deep inside=nwin
-                dist      = dist/nwin                     # normalize to [0,1]
-                dist      = dist[1:nnx+1,1:nny+1]         # trim the expansion
-                mask      = 0.5*(1.0-np.cos(np.pi*dist))  # Tukey window
-                image     = image * mask                  # apply
-
-                del dist,mask
-
-            # Deconvolution 
-            imageFT          = np.fft.fft2(image,axes=(0,1))
-            imageFTdec       = imageFT.copy()
-            idx0             = (uvgrd2   > (uvcut**2))    # idx of outer uv
-            idx1             = np.logical_not(idx0)       # idx of inner uv
-            imageFTdec[idx1] = imageFT[idx1]/beamFT[idx1] # just for inner uv
-            imageFTdec[idx0] = 0.0                        # set outer uv zero
-            imagedec         = np.fft.ifft2(imageFTdec)
-            ia2.putchunk(np.real(imagedec), blc=[0,0,0,iz])
+                kern['schwab_in'] = schwab_ft[inner]
+            print("Using rfft2 deconvolution, %d inner uv cells" % len(inner[0]))
+            del uvgrd2,schwab_ft
+        else:
+            kern      = {'uvgrd2': uvgrd2, 'uvcut': uvcut, 'schwab_ft': schwab_ft}
+
+        # Memory budget for the blocks: what is left after the kernel,
+        # shared by the processes, and with nproc>1 the block the parent
+        # stages (and reads back) next to them
+        nshare = nproc + 1 if nproc > 1 else 1
+        if maxmem != None:
+            kbytes = 0
+            for k in kern.values():
+                for a in (k if type(k) == type(()) else [k]):
+                    kbytes = kbytes + getattr(a,'nbytes',0)
+            budget = (maxmem*1.0e9 - kbytes) / nshare
+            print("Memory budget %g GB, kernel %.3f GB" % (maxmem,kbytes/1.0e9))
+        else:
+            budget = None
+
+        # Loop over blocks of channels
+        wincache = OrderedDict()                          # Tukey windows by mask
+        nblk = chanblock(cb_nx,cb_ny,cb_nchan,nblock,0.25/nshare,rfft,budget,
+                         schwab=use_schwab)
+        print("Deconvolution loop starts, %d channels per block" % nblk)
+        (mself0,mchild0) = peakmem()                      # peak before the loop
+        blocks = []
+        if nproc > 1:                                     # staged cubes for the workers
+            decin  = 'tmp_decin_'  + dd + '.npy'
+            decout = 'tmp_decout_' + dd + '.npy'
+        try:
+            for iz0 in range(0,cb_nchan,nblk):
+                iz1       = min(iz0+nblk,cb_nchan) - 1    # last chan in block
+
+                # Beam in Fourier domain
+                freq      = cb_fstart+cb_fwidth*(0.5+np.arange(iz0,iz1+1)) # [GHz]
+                beamSigFT = tp_beamSigFT * freq/cb_reffreq
+                blocks.append((iz0,iz1,beamSigFT))
+
+                # Channel images to be deconvolved
+                image     = axchunk(ia,order,iz0,iz1)
+                image     = image[:,:,0,:]                # image[ix][iy][0][iz]
+                image     = image / nppb                  # scale to Jy/pixel
+
+                # Apply Tukey window
+                if winpix > 0:
+                    mask      = axchunk(ia,order,iz0,iz1,getmask=True)
+                    mask      = mask[:,:,0,:]             # mask[ix][iy][0][iz]
+                    for iz in range(image.shape[2]):
+                        image[:,:,iz] *= tukeycache(mask[:,:,iz],winpix,wincache)
+
+                    del mask
+
+                # Deconvolution (or stage the block for the workers)
+                if nproc > 1:
+                    if iz0 == 0:
+                        cubein = np.lib.format.open_memmap(decin,mode='w+',
+                                     dtype=image.dtype,shape=(cb_nx,cb_ny,cb_nchan))
+                        cubeout= np.lib.format.open_memmap(decout,mode='w+',
+                                     dtype=np.float64,shape=(cb_nx,cb_ny,cb_nchan))
+                        del cubeout
+                    cubein[:,:,iz0:iz1+1] = image
+                else:
+                    imagedec  = deconvplanes(image,beamSigFT,kern)
+                    ia2.putchunk(imagedec[:,:,None,:], blc=[0,0,0,iz0])
+                    del imagedec
+
+                del image
+
+            # Deconvolve the staged cube on a pool of processes
+            if nproc > 1:
+                cubein.flush()
+                del cubein
+                deconvpool(decin,decout,blocks,kern,nproc,'tmp_deckern_'+dd+'_')
+                cubeout = np.load(decout,mmap_mode='r')
+                for (iz0,iz1,beamSigFT) in blocks:
+                    ia2.putchunk(cubeout[:,:,None,iz0:iz1+1], blc=[0,0,0,iz0])
+                del cubeout
+        finally:
+            if nproc > 1:                                 # also after an error
+                for f in [decin,decout]:
+                    if os.path.exists(f):
+                        os.remove(f)
+
+        (mself,mchild) = peakmem()
+        if mself != None:
+            print("Process peak memory (lifetime): %.3f GB before the deconvolution, %.3f GB after" %
+                  (mself0/1.0e9,mself/1.0e9))
+            if nproc > 1:
+                print("Largest worker peak memory (lifetime): %.3f GB" % (mchild/1.0e9))
 
         ia2.close()
         imhead(imagedecname,mode='put',hdkey='bunit',hdvalue='Jy/pixel')
@@ -545,10 +1553,19 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
 
     nant            = 46                        # # of fake antennas
     npair           = (nant*(nant-1))//2        # # of baselines
-    nvis            = npair * nvgrp             # # of vis per point
     source          = cb_objname                # object name
     npnt            = len(pointings)
 
+    # Adaptive number of visibilities: enough to sample the uv footprint
+    if nvgrp == 'auto':
+        nvref = 5                               # create_TP2VIS_ms() default
+        nvgrp = autonvgrp(npair,vi_beamSigFT*cb_refwave,(uvcut*cb_refwave)**2,
+                          seed=seed,tol=nvtol)
+        print("nvgrp=auto: %d for tolerance %g" % (nvgrp,nvtol))
+        print("   %d rows instead of %d for nvgrp=%d: %.0f%% of the rows and gridding time" %
+              (npnt*npair*nvgrp,npnt*npair*nvref,nvref,100.0*nvgrp/nvref))
+    nvis            = npair * nvgrp             # # of vis per point
+
     # Spectral windows
     spw_nchan       = cb_nchan                  # # of channels
     spw_fstart      = cb_fstart                 # start freq [GHz]
@@ -576,6 +1593,8 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
     else:
         obs_obsname     = t2v_arrays['VIRTUAL']['observatory'] # observatory
         obs_obspos      = me.observatory(obs_obsname)          # coordinate
+    obs_reftime     = me.epoch('utc', 'today')              # hour angles refer to this day
+    obs_refday      = int(obs_reftime['m0']['value'])       # [MJD]
 
     # Telescopes
     tel_pbFWHM      = t2v_arrays['VIRTUAL']['fwhm100']*(100./spw_fstart) # asec
@@ -631,83 +1650,108 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
     spw_fwidth        = str(spw_fwidth)      + 'GHz'
     spw_fresolution   = str(spw_fresolution) + 'GHz'
 
-    if seed >= 0:
-        np.random.seed(seed)
-  
-    sm.open(outfile)
-    
-    if use_vp:
-        vptable = outfile + '/TP2VISVP'
-        vp.saveastable(vptable)
+    # Skeleton MS (the configuration, fields and empty visibilities)
+    # only depends on the pointings, observatory, reference day and
+    # spectral setup, so it can be cloned from a cached copy and only
+    # UVW, WEIGHT and DATA refilled
+    if cache:
+        skelkey = ('skeleton',tuple(pointings),source,nant,nvgrp,tvis,
+                   obs_obsname,obs_obspos,obs_refday,tel_antname,tel_dish,use_vp,
+                   spw_nchan,spw_fstart,spw_fwidth,spw_fresolution,spw_refcode,spw_stokes)
+        skel    = skelname(skelkey)
+        if skel == None:
+            print("WARNING: cache=True needs t2v_cachedir, the skeleton MS is not cached")
     else:
-        vptable = None
-
-    print("OBS/TEL:",obs_obsname, obs_obspos, tel_antname, tel_mounttype, tel_coordsystem, tel_antdiam)
-
-    sm.setconfig(telescopename=obs_obsname,
-                referencelocation=obs_obspos,
-                antname=tel_antname,
-                mount=tel_mounttype,
-                coordsystem=tel_coordsystem,
-                x=tel_antposx,y=tel_antposy,z=tel_antposz,
-                dishdiameter=tel_antdiam)
-
-    sm.setspwindow(spwname=spw_fband,
-                freq=spw_fstart,
-                deltafreq=spw_fwidth,
-                freqresolution=spw_fresolution,
-                nchannels=spw_nchan,
-                refcode=spw_refcode,
-                stokes=spw_stokes)
-
-    sm.setfeed(mode=fed_mode,
-                pol=fed_pol)
-
-    for k in range(0,npnt):
-        this_pointing = pointings[k]
-        src = source + '_%d' % (k)
-        # src = source                                     # uniq field ID's are not neeed (Petry 2019)        
-        sm.setfield(sourcename=src,
-                sourcedirection=this_pointing,
-                calcode=fld_calcode,
-                distance=fld_distance)
-
-    sm.setlimits(shadowlimit=0.001,
-                elevationlimit='10deg')
-
-    sm.setauto(autocorrwt=0.0)
-
-    sm.settimes(integrationtime=str(tvis)+'s',
-                usehourangle=True,
-                referencetime=me.epoch('utc', 'today'))
+        skel    = None
+
+    if skel != None and os.path.isdir(skel):
+        print("Using cached skeleton MS %s" % skel)
+        shutil.copytree(skel,outfile,symlinks=True)
+        sm.openfromms(outfile)
+        if use_vp:
+            vptable = outfile + '/TP2VISVP'
+        else:
+            vptable = None
+    else:
+        sm.open(outfile)
 
-    # Generate (empty) visibilities
-    # =============================
+        if use_vp:
+            vptable = outfile + '/TP2VISVP'
+            vp.saveastable(vptable)
+        else:
+            vptable = None
+
+        print("OBS/TEL:",obs_obsname, obs_obspos, tel_antname, tel_mounttype, tel_coordsystem, tel_antdiam)
+
+        sm.setconfig(telescopename=obs_obsname,
+                    referencelocation=obs_obspos,
+                    antname=tel_antname,
+                    mount=tel_mounttype,
+                    coordsystem=tel_coordsystem,
+                    x=tel_antposx,y=tel_antposy,z=tel_antposz,
+                    dishdiameter=tel_antdiam)
+
+        sm.setspwindow(spwname=spw_fband,
+                    freq=spw_fstart,
+                    deltafreq=spw_fwidth,
+                    freqresolution=spw_fresolution,
+                    nchannels=spw_nchan,
+                    refcode=spw_refcode,
+                    stokes=spw_stokes)
+
+        sm.setfeed(mode=fed_mode,
+                    pol=fed_pol)
+
+        for k in range(0,npnt):
+            this_pointing = pointings[k]
+            src = source + '_%d' % (k)
+            # src = source                                     # uniq field ID's are not neeed (Petry 2019)        
+            sm.setfield(sourcename=src,
+                    sourcedirection=this_pointing,
+                    calcode=fld_calcode,
+                    distance=fld_distance)
+
+        sm.setlimits(shadowlimit=0.001,
+                    elevationlimit='10deg')
+
+        sm.setauto(autocorrwt=0.0)
+
+        sm.settimes(integrationtime=str(tvis)+'s',
+                    usehourangle=True,
+                    referencetime=obs_reftime)
+
+        # Generate (empty) visibilities
+        # =============================
+
+        # This step generates (u,v,w), based on target coord and antpos
+        # following current CASA implementation, but (u,v,w) will be
+        # replaced in the next step.
+
+        print("Running sm.observemany")
+        sources    = []
+        starttimes = []
+        stoptimes  = []
+
+        tstart_src = tstart
+        tend_src   = tstart_src + tpnt
 
-    # This step generates (u,v,w), based on target coord and antpos
-    # following current CASA implementation, but (u,v,w) will be
-    # replaced in the next step.
-    
-    print("Running sm.observemany")
-    sources    = []
-    starttimes = []
-    stoptimes  = []
+        for k in range(npnt):
+            src = source + '_%d' % (k)
+            sources.append(src)
+            starttimes.append(str(tstart_src)+'s')
+            stoptimes.append(str(tend_src)+'s')
+            tstart_src = tstart_src + tpnt
+            tend_src   = tstart_src + tpnt
 
-    tstart_src = tstart
-    tend_src   = tstart_src + tpnt
-    
-    for k in range(npnt):
-        src = source + '_%d' % (k)
-        sources.append(src)
-        starttimes.append(str(tstart_src)+'s')
-        stoptimes.append(str(tend_src)+'s')
-        tstart_src = tstart_src + tpnt
-        tend_src   = tstart_src + tpnt
+        sm.observemany(sourcenames=sources,
+                spwname=spw_fband,
+                starttimes=starttimes,
+                stoptimes=stoptimes)
 
-    sm.observemany(sourcenames=sources,
-            spwname=spw_fband,
-            starttimes=starttimes,
-            stoptimes=stoptimes)
+        if skel != None:                        # save a copy before UVW is replaced
+            sm.close()
+            skelsave(outfile,skel)
+            sm.openfromms(outfile)
 
     # Genarate (replace) (u,v,w) to follow Gaussian
     # =============================================
@@ -715,49 +1759,28 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
     # Beam size in uv [m]
     beamSigFT = vi_beamSigFT*cb_refwave         # sigmaF=D/lambda -> D [m]
 
-    # Include (u,v) = (0,0)
-    uu = np.array([0.0])
-    vv = np.array([0.0])
-
-    # Rest follows Gaussian distribution with < uvcut^2
-    nuv = 1                                     # (0,0) exists already
+    # Include (u,v) = (0,0), the rest follows Gaussian distribution with < uvcut^2
     uvcut2 = (uvcut*cb_refwave)**2              # 1/lambda -> meter
-    while (nuv<nvis):                           # loop until enough
-        nrest = nvis-nuv
-        utmp,vtmp = np.random.normal(scale=beamSigFT,size=(2,nrest))
-        ok    = utmp**2+vtmp**2 < uvcut2        # generate gauss and
-        uu    = np.append(uu,utmp[ok])          # ok for uvdist<uvcut
-        vv    = np.append(vv,vtmp[ok])
-        nuv   = uu.size
-
-    uu = uu[:nvis]
-    vv = vv[:nvis]
-    ww = np.zeros(nvis)
-
-    del utmp,vtmp, ok
+    uu,vv  = uvsample(nvis,beamSigFT,uvcut2,seed)
 
     # Replicate the same uv set for all pointings
-    if npnt > 1:
-        uu = np.ravel([uu,]*npnt)
-        vv = np.ravel([vv,]*npnt)
-        ww = np.ravel([ww,]*npnt)
-
-    nuvw = uu.shape[0]
+    uvw    = uvwtile(uu,vv,npnt)
+    nuvw   = uvw.shape[1]
     tb.open(outfile,nomodify=False)
-    uvw  = tb.getcol('UVW')
-    print("UVW shape",uvw.shape,nuvw,uvw[:,1])     # IndexError: too many indices for array
-    if len(np.ravel(uvw)) > 0:
-        nrow = uvw.shape[1]
+    nrow   = tb.nrows()
+    print("UVW rows",nrow,nuvw)
+    if nrow > 0:
         if nrow == nuvw:
-            uvw = np.array([uu,vv,ww])
             tb.putcol('UVW',uvw)
-            print("UVW0",uu[1],vv[1],ww[1])
+            print("UVW0",uu[1],vv[1],0.0)
         else:
             print("Bad UVW",nrow,nuvw)
     else:
         print("WARNING: no uvw?")
 
 
+    tb.close()
+
     # Set WEIGHT and SIGMA columns temporarily
     # ========================================
 
@@ -767,36 +1790,56 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
 
     if rms != None:
         print("Adjusting the weights using rms = %g  nvis=%d" % (rms,nvis))
-        weight = tb.getcol('WEIGHT')
         w = rms * np.sqrt(nvis)
         w = 1.0/(w*w)
-        print("WEIGHT: Old=%s New=%g Nvis=%d" % (weight[0,0],w,nvis))
-        weight[:,:] = w                         # weight[npol,nvis*npnt]
-        tb.putcol('WEIGHT',weight)              # set WEIGHT
-        sigma = 1/np.sqrt(weight)               # SIGMA
-        tb.putcol('SIGMA',sigma)                # set SIGMA
+        print("WEIGHT: New=%g Nvis=%d" % (w,nvis))
+        wtupdate(outfile,wtconst(w))            # set WEIGHT and SIGMA
     else:
         print("The WEIGHT column is not filled, all 1.0")
-    tb.close()
 
     del uvw
 
     # Fill vis amp/phase based on deconvolved TP image
     # ================================================
 
-    sm.setdata(fieldid=list(range(0,npnt)))     # set all fields
-    if use_vp:                                  # set primary beam
-        # according to Kumar
-        sm.setvp(dovp=True,usedefaultvp=False, vptable=vptable)
+    if deconv:
+        modelname = imagedecname                # deconvolved cube
+        modelorder= '0123'
     else:
-        sm.setvp(dovp=True,usedefaultvp=False)
+        modelname = imagename                   # input TP cube
+        modelorder= order
+
+    delmodel = False
+    if predict in ['sm','check'] and modelorder != '0123':
+        modelname = arangeax(imagename)         # sm.predict needs the axes in order
+        modelorder= '0123'
+        delmodel  = True
+
+    if predict in ['sm','check']:
+        sm.setdata(fieldid=list(range(0,npnt))) # set all fields
+        if use_vp:                              # set primary beam
+            # according to Kumar
+            sm.setvp(dovp=True,usedefaultvp=False, vptable=vptable)
+        else:
+            sm.setvp(dovp=True,usedefaultvp=False)
+
+        print("Running sm.predict")             # Replace amp/pha - key task
+        sm.predict(imagename=modelname)
+
+    if predict == 'numpy':
+        print("Running nppredict")
+        nppredict(outfile,modelname,vi_beamSigma,cb_reffreq*1.0e9,order=modelorder)
+    elif predict == 'check':
+        print("Comparing sm.predict with nppredict")
+        (rms_sm,rms_diff) = nppredict(outfile,modelname,vi_beamSigma,cb_reffreq*1.0e9,
+                                      compare=True,order=modelorder)
+        print("PREDICT check: rms(sm) = %g  rms(numpy-sm) = %g  ratio = %g" %
+              (rms_sm,rms_diff,rms_diff/rms_sm))
 
-    print("Running sm.predict")                 # Replace amp/pha - key task
     if deconv:
-        sm.predict(imagename=imagedecname)      # deconvolved cube
         os.system('rm -rf %s' % imagedecname)   # remove the temp file
-    else:
-        sm.predict(imagename=imagename)         # input TP cube
+    if delmodel:
+        os.system('rm -rf %s' % modelname)      # and the re-aranged copy
 
     # Print Summary
     sm.summary()
@@ -824,7 +1867,7 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
         # REST_FREQUENCY in /SOURCE
         #    Having REST_FREQUENCY in header does not make sense (since
         #    multiple lines, but CASA MS does have it. So, put it in.
-        h0       = imhead(imagename,mode='list')
+        h0       = axhead(imhead(imagename,mode='list'),order)
 
         if 'restfreq' in list(h0.keys()):
             restfreq = h0['restfreq'][0]        # restfreq from image header
@@ -857,21 +1900,293 @@ def tp2vis(infile, outfile, ptg, maxuv=10.0, rms=None, nvgrp=4, deconv=True, win
     if not bug028_Fixed:
         print("Set offset time stamps between fields [bug028]")
         # clean task requires different time stamps for different fields
-        tb.open(outfile,nomodify=False)
-        time0 = tb.getcol("TIME")
-        time1 = tb.getcol("TIME_CENTROID")
-        t0    = time0[0]
-        time0 = [t0 + 1.*ii for ii in range(len(time0))]
-        time1 = time0
-        tb.putcol('TIME',time0)
-        tb.putcol('TIME_CENTROID',time1)
-        tb.close()
+        fixtimes(outfile)
 
-    if delimage:
-        os.system('rm -rf %s' % imagename)
+    if export != None:
+        tp2visexport(outfile,export)
 
     #-end of tp2vis()
 
+## =======================================================
+## TP2VIS_BATCH: run tp2vis on many cubes in parallel
+## =======================================================
+
+def tp2vis_job(job):
+    """ run one tp2vis_batch() job in its own scratch directory
+    job        dict with infile, outfile, ptg, rms, kwargs, scratch, cachedir
+    Returns the manifest entry of the job
+            Helper function for tp2vis_batch()
+    """
+    global t2v_cachedir
+    entry = {'infile': job['infile'], 'outfile': job['outfile'],
+             'ok': False, 'seconds': 0.0, 'error': ''}
+    cwd   = os.getcwd()
+    t0    = time.time()
+    cachedir     = t2v_cachedir
+    t2v_cachedir = job['cachedir']              # not inherited by spawned processes
+    try:
+        os.makedirs(job['scratch'])
+        os.chdir(job['scratch'])                # tmp_* files of tp2vis go here
+        tp2vis(job['infile'],job['outfile'],job['ptg'],rms=job['rms'],**job['kwargs'])
+        entry['ok'] = os.path.isdir(job['outfile'])
+    except Exception as e:
+        entry['error'] = repr(e)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(job['scratch'],ignore_errors=True)
+        t2v_cachedir = cachedir
+    entry['seconds'] = time.time() - t0
+    return entry
+
+def tp2vis_batch(jobs, nproc=2, scratch='.', **kwargs):
+    """
+    Run tp2vis() on a list of jobs on a pool of nproc processes
+    jobs      list of (infile, ptg, rms), (infile, ptg, rms, outfile) or
+              (infile, ptg, rms, outfile, export) tuples.
+              The default outfile is infile with .image (or .im) replaced by .ms
+    nproc     maximum number of tp2vis() runs at the same time
+    scratch   directory in which each job gets its own scratch directory
+    kwargs    passed to every tp2vis(), e.g. nvgrp=5 or cache=True. With cache=True
+              jobs that share the pointings and spectral setup reuse one skeleton MS
+              (in t2v_cachedir). export can only be given here as an extension,
+              '.zarr' or '.h5', and each job then exports to its outfile with .ms
+              replaced by it; an export path would be shared by all jobs.
+    Pointing files are read once, and passed to the jobs as lists.
+    The processes are started fresh (spawn), as the CASA tools of the parent
+    cannot be shared, and each handles a single job.
+    Returns the manifest, a list with for each job a dict with
+    infile, outfile, ok, seconds and error
+    Example usage:
+    --------------
+    > m = tp2vis_batch([('spw25.image','12m.ptg',0.1), ('spw27.image','12m.ptg',0.12)],nproc=2)
+    """
+    import multiprocessing as mp
+
+    exportext = kwargs.pop('export',None)
+    if exportext != None and exportext.lower() not in ['.zarr','.h5','.hdf5']:
+        raise Exception("ERROR: export=%s would be written by every job, give an extension "
+                        "('.zarr' or '.h5') or an export per job" % exportext)
+    cachedir = t2v_cachedir
+    if cachedir != None:
+        cachedir = os.path.abspath(cachedir)
+
+    dd    = ''.join(re.findall('[0-9]',str(datetime.datetime.now())))
+    ptgs  = {}                                  # pointing files, read once
+    todo  = []
+    for (k,job) in enumerate(jobs):
+        (infile,ptg,rms) = job[0:3]
+        if len(job) > 3:
+            outfile = job[3]
+        else:
+            outfile = re.sub(r'\.im(age)?$','',infile.rstrip('/')) + '.ms'
+        if len(job) > 4:
+            export  = job[4]
+        elif exportext != None:
+            export  = re.sub(r'\.ms$','',outfile.rstrip('/')) + exportext
+        else:
+            export  = None
+        if export != None:                      # not in the scratch directory
+            export  = os.path.abspath(export)
+        if type(ptg) != type([]):
+            if ptg not in ptgs:
+                ptgs[ptg] = getptg(ptg)
+            ptg = ptgs[ptg]
+        todo.append({'infile':  os.path.abspath(infile),
+                     'outfile': os.path.abspath(outfile),
+                     'ptg':     ptg,
+                     'rms':     rms,
+                     'kwargs':  dict(kwargs,export=export),
+                     'scratch': os.path.abspath(os.path.join(scratch,
+                                    'tmp_tp2vis_batch_%s_%d' % (dd,k))),
+                     'cachedir': cachedir})
+
+    nproc = max(1,min(nproc,len(todo)))
+    print("TP2VIS_BATCH: %d jobs on %d processes" % (len(todo),nproc))
+    t0    = time.time()
+    if nproc == 1:
+        manifest = [tp2vis_job(job) for job in todo]
+    else:
+        pool = mp.get_context('spawn').Pool(nproc,maxtasksperchild=1)
+        try:
+            manifest = pool.map(tp2vis_job,todo,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    for entry in manifest:
+        print("%-40s %8.1f sec  %s %s" % (entry['outfile'],entry['seconds'],
+              'OK' if entry['ok'] else 'FAILED',entry['error']))
+    print("TP2VIS_BATCH: %.1f sec for %d jobs" % (time.time()-t0,len(todo)))
+    return manifest
+
+## =======================================================
+## TP2VISEXPORT: Zarr/HDF5 copy of the visibilities
+## =======================================================
+
+def isvisstore(name):
+    """ True if name is a tp2visexport() store (.zarr, .h5 or .hdf5), not an MS
+            Helper function for tp2visexport(), tp2viswt() and tp2vispl()
+    """
+    return os.path.splitext(name.rstrip('/'))[1].lower() in ['.zarr','.h5','.hdf5']
+
+def visstore(name, mode='r'):
+    """ open the store name, with zarr for a .zarr directory and with h5py
+    for a .h5 or .hdf5 file. Neither package is needed by the rest of tp2vis.
+            Helper function for tp2visexport() and the store readers
+    """
+    if name.rstrip('/').lower().endswith('.zarr'):
+        try:
+            import zarr
+        except ImportError:
+            raise Exception("ERROR: zarr is needed for %s (pip install zarr)" % name)
+        return zarr.open_group(name.rstrip('/'),mode=mode)
+    try:
+        import h5py
+    except ImportError:
+        raise Exception("ERROR: h5py is needed for %s (pip install h5py)" % name)
+    return h5py.File(name,mode)
+
+def visclose(store):
+    """ close an open visstore() (only h5py files need it)
+            Helper function for tp2visexport() and the store readers
+    """
+    if hasattr(store,'close'):
+        store.close()
+
+def storespw(name):
+    """ return (npol, spwinfo) of the store name, with spwinfo in the
+    format of ms.getspectralwindowinfo(), one entry per data description
+            Helper function for tp2viswt() and tp2vispl()
+    """
+    f       = visstore(name)
+    spwinfo = {}
+    npol    = 0
+    for g in sorted(f.keys()):
+        dd    = int(f[g].attrs['ddid'])
+        freq  = f[g]['chan_freq'][:]
+        width = f[g]['chan_width'][:]
+        npol  = int(f[g].attrs['npol'])
+        spwinfo[str(dd)] = {'SpectralWindowId': dd, 'NumChan': len(freq),
+                            'Chan1Freq': freq[0], 'ChanWidth': width[0]}
+    visclose(f)
+    return (npol,spwinfo)
+
+def storeread(name, ddid, uvmax, ichan=None, nrow=1000000):
+    """ return, like ms.getdata(), field_id, u, v [m] and weight[pol][row] of
+    the rows of data description ddid in the store name with a uv distance
+    up to uvmax [m]; with ichan also the amplitude of that channel averaged
+    over the polarizations. Only the chunks of channel ichan are read.
+            Helper function for tp2vispl()
+    """
+    f    = visstore(name)
+    g    = f['dd%d' % ddid]
+    nr   = g['field_id'].shape[0]
+    rec  = {'field_id': [], 'u': [], 'v': [], 'weight': [], 'amplitude': []}
+    for r0 in range(0,nr,nrow):
+        r1  = min(nr,r0+nrow)
+        uvw = g['uvw'][r0:r1]
+        idx = np.nonzero(uvw[:,0]**2 + uvw[:,1]**2 <= uvmax**2)[0]
+        rec['field_id'].append(g['field_id'][r0:r1][idx])
+        rec['u'].append(uvw[idx,0])
+        rec['v'].append(uvw[idx,1])
+        rec['weight'].append(g['weight'][r0:r1][idx].T)
+        if ichan != None:
+            data = g['data'][r0:r1,ichan,:]     # (row,pol)
+            rec['amplitude'].append(np.abs(data[idx]).mean(axis=1))
+    visclose(f)
+    for k in ['field_id','u','v','amplitude']:
+        rec[k] = np.concatenate(rec[k]) if rec[k] != [] else np.zeros(0)
+    rec['weight'] = np.concatenate(rec['weight'],axis=1)
+    return rec
+
+def tp2visexport(msname, outfile, nrow=100000, nchunk=64):
+    """
+    Export the visibilities of msname (e.g. from tp2vis) to a chunked and
+    compressed Zarr (outfile ending in .zarr) or HDF5 (.h5, .hdf5) store,
+    which tp2viswt(mode='stat') and tp2vispl() also accept instead of an MS.
+    msname    measurement set
+    outfile   store name, overwritten if it exists
+    nrow      rows per chunk
+    nchunk    channels per chunk of data
+    Layout: one group ddN per data description N, with the rows of that data
+    description in MS order:
+       uvw[row][3] [m], weight[row][pol], field_id[row], flag_row[row],
+       data[row][chan][pol], chan_freq[chan] [Hz], chan_width[chan] [Hz]
+    and attributes ddid, spwid, npol. The root has msname and array (guessarray).
+    Example usage:
+    --------------
+    > tp2visexport('tp.ms','tp.zarr')
+    > tp2vispl(['tp.zarr','12m.ms'])
+    """
+    print("TP2VISEXPORT: %s -> %s" % (msname,outfile))
+    array = guessarray(msname)
+
+    tb.open(msname + '/DATA_DESCRIPTION')
+    spwid = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+    tb.open(msname + '/SPECTRAL_WINDOW')
+    freqs = [tb.getcell('CHAN_FREQ',k)  for k in spwid]
+    wids  = [tb.getcell('CHAN_WIDTH',k) for k in spwid]
+    tb.close()
+
+    if os.path.isdir(outfile):
+        shutil.rmtree(outfile)
+    f     = visstore(outfile,'w')
+    f.attrs['msname'] = os.path.abspath(msname)
+    f.attrs['array']  = array
+    if outfile.rstrip('/').lower().endswith('.zarr'):
+        comp = {}                               # zarr compresses by default
+    else:
+        comp = {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+
+    tb.open(msname)
+    ddcol = tb.getcol('DATA_DESC_ID')
+    ncorr = tb.getcell('DATA',0).shape[0]
+    counts= np.bincount(ddcol,minlength=len(spwid))
+    groups= {}
+    for dd in np.nonzero(counts)[0]:
+        nr    = int(counts[dd])
+        nchan = len(freqs[dd])
+        rchunk= max(1,min(nr,nrow))
+        g     = f.create_group('dd%d' % dd)
+        g.attrs['ddid']  = int(dd)
+        g.attrs['spwid'] = int(spwid[dd])
+        g.attrs['npol']  = int(ncorr)
+        g.create_dataset('uvw',shape=(nr,3),dtype='f8',chunks=(rchunk,3),**comp)
+        g.create_dataset('weight',shape=(nr,ncorr),dtype='f4',chunks=(rchunk,ncorr),**comp)
+        g.create_dataset('field_id',shape=(nr,),dtype='i4',chunks=(rchunk,),**comp)
+        g.create_dataset('flag_row',shape=(nr,),dtype='bool',chunks=(rchunk,),**comp)
+        g.create_dataset('data',shape=(nr,nchan,ncorr),dtype='c8',
+                         chunks=(rchunk,min(nchan,nchunk),ncorr),**comp)
+        g['chan_freq'] = np.asarray(freqs[dd])
+        g['chan_width']= np.asarray(wids[dd])
+        groups[dd] = [g,0]                      # group, rows written
+
+    # Rows are read in chunks and appended to the group of their data description
+    nrows = len(ddcol)
+    for r0 in range(0,nrows,nrow):
+        nr   = min(nrow,nrows-r0)
+        dd   = ddcol[r0:r0+nr]
+        uvw  = tb.getcol('UVW',startrow=r0,nrow=nr).T
+        wt   = tb.getcol('WEIGHT',startrow=r0,nrow=nr).T
+        fid  = tb.getcol('FIELD_ID',startrow=r0,nrow=nr)
+        flag = tb.getcol('FLAG_ROW',startrow=r0,nrow=nr)
+        data = tb.getcol('DATA',startrow=r0,nrow=nr)         # (pol,chan,row)
+        for k in np.unique(dd):
+            idx  = np.nonzero(dd == k)[0]
+            (g,w0) = groups[k]
+            w1   = w0 + len(idx)
+            g['uvw'][w0:w1]      = uvw[idx]
+            g['weight'][w0:w1]   = wt[idx]
+            g['field_id'][w0:w1] = fid[idx]
+            g['flag_row'][w0:w1] = flag[idx]
+            g['data'][w0:w1]     = np.transpose(data[:,:,idx],(2,1,0))
+            groups[k][1] = w1
+        del data
+    tb.close()
+    visclose(f)
+    print("TP2VISEXPORT: %d rows in %d data descriptions" % (nrows,len(groups)))
+
 ## =======================================================
 ## TP2VISBL: Return baselines (a primitive of tp2vis)
 ## =======================================================
@@ -937,20 +2252,16 @@ def tp2visbl(infile, ptg=None, dish=12.0, maxuv=10.0, nvgrp=4, seed=123):
     # Query the input image
     # =====================
 
-    # Ensure RA-DEC-POL-FREQ axis order (CASA simulator needs it)
-    if axinorder(infile):                       # if 4 axes in order
-        imagename = infile                      # use original file
-        delimage  = False
-    else:                                       # if not, rearrange
-        imagename = arangeax(infile)            # and use re-aranged data
-        delimage  = True        
+    # Only the header is used: read it in RA-DEC-POL-FREQ axis order
+    imagename = infile
+    order     = axorder(infile)
 
     # Parameters from TP cube header
     # ==============================
 
     cms    = qa.constants('c')['value']         # speed of light in m/s
 
-    h0         = imhead(imagename,mode='list')
+    h0         = axhead(imhead(imagename,mode='list'),order)
     cb_shape   = h0['shape']                    # cube shape
     cb_nx      = h0['shape'][0]                 # num of pixels, RA
     cb_ny      = h0['shape'][1]                 #              , DEC
@@ -1021,12 +2332,7 @@ def tp2visbl(infile, ptg=None, dish=12.0, maxuv=10.0, nvgrp=4, seed=123):
     print("UVCUT:", uvcut/1000.0,"kLambda")
 
     # Generate uvdist^2 image [notice: x-axis runs vertically] 
-    frqx      = np.fft.fftfreq(cb_nx,cb_dx)     # frequency in x
-    frqy      = np.fft.fftfreq(cb_ny,cb_dy)     # frequency in y
-    vgrd,ugrd = np.meshgrid(frqy,frqx)          # make grids
-    uvgrd2    = ugrd**2+vgrd**2                 # uvdist^2 image
-
-    del frqx,frqy,vgrd,ugrd
+    uvgrd2    = uvgrid2(cb_nx,cb_ny,cb_dx,cb_dy)
 
     # List parameters for virtual interferometric obs
     # ===============================================
@@ -1123,9 +2429,6 @@ def tp2visbl(infile, ptg=None, dish=12.0, maxuv=10.0, nvgrp=4, seed=123):
     spw_fwidth        = str(spw_fwidth)      + 'GHz'
     spw_fresolution   = str(spw_fresolution) + 'GHz'
 
-    if seed >= 0:
-        np.random.seed(seed)
-
     # Generate (empty) visibilities
     # =============================
 
@@ -1160,24 +2463,9 @@ def tp2visbl(infile, ptg=None, dish=12.0, maxuv=10.0, nvgrp=4, seed=123):
     # Beam size in uv [m]
     beamSigFT = vi_beamSigFT*cb_refwave         # sigmaF=D/lambda -> D [m]
 
-    # Include (u,v) = (0,0)
-    uu = np.array([0.0])
-    vv = np.array([0.0])
-
-    # Rest follows Gaussian distribution with < uvcut^2
-    nuv = 1                                     # (0,0) exists already
+    # Include (u,v) = (0,0), the rest follows Gaussian distribution with < uvcut^2
     uvcut2 = (uvcut*cb_refwave)**2              # 1/lambda -> meter
-    while (nuv<nvis):                           # loop until enough
-        nrest = nvis-nuv
-        utmp,vtmp = np.random.normal(scale=beamSigFT,size=(2,nrest))
-        ok    = utmp**2+vtmp**2 < uvcut2        # generate gauss and
-        uu    = np.append(uu,utmp[ok])          # ok for uvdist<uvcut
-        vv    = np.append(vv,vtmp[ok])
-        nuv   = uu.size
-
-    uu = uu[:nvis]
-    vv = vv[:nvis]
-    ww = np.zeros(nvis)
+    uu,vv  = uvsample(nvis,beamSigFT,uvcut2,seed)
 
     return (uu,vv)
 
@@ -1194,11 +2482,12 @@ def tp2visbl(infile, ptg=None, dish=12.0, maxuv=10.0, nvgrp=4, seed=123):
 ## TP2VISWT: Explore different weights for TP visibilities
 ## =======================================================
            
-def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
+def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True, psfmode='tclean'):
     """
     Parameters
     -----------
-    mslist     MS(s) to report weights, or compute new weights for
+    mslist     MS(s) to report weights, or compute new weights for.
+               For mode='stat' these can also be tp2visexport() stores
     value      (mode=1,2,3) value to be applied applied to weight
     
     mode       0 or 'statistics'   (default)
@@ -1207,6 +2496,11 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
                3 or 'rms'
                4 or 'beammatch'
     makepsf    True/False for mode='beammatch'
+    psfmode    How mode='beammatch' gets the INT and TP beam areas:
+               'tclean'  from the restoringbeam of tclean(niter=0) PSFs (default)
+               'uv'      from the weighted uv second moments, see uvbeam(),
+                         no imaging and cached per MS
+               'check'   both, report the 'uv' values but use 'tclean'
     Example usage:
     --------------
     Report weights for "v1.ms"
@@ -1256,16 +2550,33 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
 
     # Define stat outputs
     # -------------------
-    def wtstat(mslist,comment=''):
+    def wtstat(mslist,comment='',accs=None):
+        """ print the weight statistics, from a single pass over each MS,
+        or from accs[ims] (from wtupdate()) if given; returns them all
+        """
         print("%-4s%18s %4s %4s %4s %8s %8s %12s %12s %12s %12s" \
             % (comment,'name','spw#','npnt','npol','nvis',\
                    'fwidth','min','max','mean','std'))
 
+        if accs == None:
+            accs = {}
         for ims in mslist:
 
-            ms.open(ims,nomodify=True)          # open MS
-            ms.selectinit(reset=True)           # all spws
-            spwinfo= ms.getspectralwindowinfo() # get spw info
+            if ims not in accs:
+                accs[ims] = wtscan(ims)         # WEIGHT stats per ddid
+            acc = accs[ims]
+
+            if isvisstore(ims):                 # tp2visexport() store
+                (npol,spwinfo) = storespw(ims)
+            else:
+                tb.open(ims)
+                npol = tb.getcell('WEIGHT',0).shape[0]  # num of polarizations
+                tb.close()
+
+                ms.open(ims,nomodify=True)      # open MS
+                ms.selectinit(reset=True)       # all spws
+                spwinfo= ms.getspectralwindowinfo() # get spw info
+                ms.close()
             spwlist= list(spwinfo.keys())       # list of SPWs
 
             for ispw in spwlist:                # get SPW info and WEIGHT
@@ -1274,19 +2585,11 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
                 chan1freq = spwinfo[ispw]['Chan1Freq'] / 1.0e9 # GHz
                 chanwidth = spwinfo[ispw]['ChanWidth'] / 1.0e9 # GHz
 
-                ms.selectinit(reset=True)           # new since 5.3.0-97
-                ms.selectinit(datadescid=spwid)
-
-                field_id  = np.unique(ms.getdata('field_id')['field_id'])
-                npnt      = len(field_id)       # num of fields
-                weight    = ms.getdata('weight')['weight'] # (npol,nvis)
-                npol      = weight.shape[0]     # num of polarizations
-                nvis      = weight.size         # num of visibilities
-
-                wmin      = weight.min()        # weight min
-                wmax      = weight.max()        # weight max
-                wmean     = weight.mean()       # weight mean
-                wstd      = weight.std()        # weight std deviation
+                if spwid not in acc:            # datadescid = spwid
+                    continue
+                (nvis,wmean,wm2,wmin,wmax,fids) = acc[spwid]
+                npnt      = len(fids)           # num of fields
+                wstd      = np.sqrt(wm2/nvis)   # weight std deviation
              
                 wmin1GHz  = wmin  / np.abs(chanwidth)
                 wmax1GHz  = wmax  / np.abs(chanwidth)
@@ -1298,8 +2601,11 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
                 print("%46s %8s %12.6f %12.6f %12.6f %12.6f" \
                     % ('','/1GHz',wmin1GHz,wmax1GHz,wmean1GHz,wstd1GHz))
 
+        return accs
 
-            ms.close()
+    if oper != 'statistics' and [ims for ims in mslist if isvisstore(ims)] != []:
+        print("TP2VISWT: tp2visexport() stores are read-only, only mode='stat' accepts them")
+        return
 
     # Calculate WEIGHT max & min (default)
     # --------------------------
@@ -1321,16 +2627,12 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
             print("TP2VISWT: set the weights = %g, sigmas = %g" \
                 % (value,1/np.sqrt(value)))
 
+        new = {}                                # stats of the new weights
         wtstat(mslist,comment="Old:")           # stat before operation
         for ims in mslist:                      # loop over MSs
-            tb.open(ims,nomodify=False)         # open MS modifiable
-            weight = tb.getcol('WEIGHT')        # get WEIGHT array format
-            weight[:,:] = value                 # constant WEIGHT[npol,nvis]
-            tb.putcol('WEIGHT',weight)          # set WEIGHT
-            sigma = 1/np.sqrt(weight)           # SIGMA
-            tb.putcol('SIGMA',sigma)            # set SIGMA
-            tb.close()                          # close MS
-        wtstat(mslist,comment="New:")           # stat after operation
+            new[ims] = {}
+            wtupdate(ims,wtconst(value),acc=new[ims])   # constant WEIGHT
+        wtstat(mslist,comment="New:",accs=new)  # stat after operation
 
         return
 
@@ -1344,16 +2646,16 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
         else:
             print("TP2VISWT: multiply the weights by %g" % (value))
 
+        def wtmult(weight, ddid):
+            weight *= value                     # multiply
+            return weight
+
+        new = {}                                # stats of the new weights
         wtstat(mslist,comment="Old:")           # stat before operation
         for ims in mslist:                      # loop over MSs
-            tb.open(ims,nomodify=False)         # open MS modifiable
-            weight = tb.getcol('WEIGHT')        # get WEIGHT
-            weight = value * weight             # multiply
-            tb.putcol('WEIGHT',weight)          # set WEIGHT
-            sigma  = 1/np.sqrt(weight)          # SIGMA
-            tb.putcol('SIGMA',sigma)            # set SIGMA
-            tb.close()                          # close MS
-        wtstat(mslist,comment="New:")           # stat after operation
+            new[ims] = {}
+            wtupdate(ims,wtmult,acc=new[ims])   # set WEIGHT and SIGMA
+        wtstat(mslist,comment="New:",accs=new)  # stat after operation
 
         return
 
@@ -1369,23 +2671,22 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
             print("  Assumption: MS has only (mosaic) pointings of ONE science")
             print("  target, and they are arranged under the Nyquist sampling.")
 
+        new = {}                                # stats of the new weights
         wtstat(mslist,comment="Old:")           # stat before operation
         for ims in mslist:                      # loop over MSs
             tb.open(ims + '/FIELD')             # open FIELD table
             src_id = tb.getcol('SOURCE_ID')     # list of source_id
             npnt = len(src_id)                  # obtain # of pointings
             tb.close()                          # close FIELD table
-            tb.open(ims,nomodify=False)         # open MS
-            weight = tb.getcol('WEIGHT')        # get WEIGHT array
-            nvis   = weight.size/npnt           # num of vis *per pnt*
+            tb.open(ims)                        # open MS
+            npol   = tb.getcell('WEIGHT',0).shape[0]
+            nvis   = npol*tb.nrows()/npnt       # num of vis *per pnt*
+            tb.close()                          # close MS
             w      = value * np.sqrt(nvis)      # WEIGHT=1/(RMS*sqrt(nvis))^2
             w      = 1.0/(w*w)
-            weight[:,:] = w                     # weight[npol,nvis]
-            tb.putcol('WEIGHT',weight)          # set WEIGHT
-            sigma  = 1/np.sqrt(weight)          # SIGMA
-            tb.putcol('SIGMA',sigma)            # set SIGMA
-            tb.close()                          # close MS
-        wtstat(mslist,comment="New:")           # stat after operation
+            new[ims] = {}
+            wtupdate(ims,wtconst(w),acc=new[ims])   # set WEIGHT and SIGMA
+        wtstat(mslist,comment="New:",accs=new)  # stat after operation
 
         return
 
@@ -1411,19 +2712,38 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
             for ims in msTP: line = line +  ", %s" % (ims)
             print(line)
 
-        wtstat(mslist,comment="Old:")               # stat before operation
+        old = wtstat(mslist,comment="Old:")         # stat before operation
+        new = {}                                    # stats of the new weights
+        for ims in msINT:                           # INT weights are unchanged
+            new[ims] = old[ims]
 
-        # Generate PSF images
-        # ===================
+        if psfmode not in ['tclean','uv','check']:
+            print("TP2VISWT ERROR: psfmode should be 'tclean', 'uv' or 'check'")
+            return
 
         cms = qa.constants('c')['value']            # Speed of light in m/s
         apr = qa.convert('1.0rad','arcsec')['value']# arcsec per radian
+
+        # Beam areas from the uv moments
+        # ==============================
+
+        if psfmode in ['uv','check']:
+            (omega_clean_uv,bmaj_int,bmin_int) = uvbeam(msINT)
+            print("INT uv beam [arcsec] = %g x %g" % (bmaj_int*apr,bmin_int*apr))
+            (omega_tp_uv,bmaj_tp,bmin_tp)      = uvbeam(msTP)
+            print("TP  uv beam [arcsec] = %g x %g" % (bmaj_tp*apr,bmin_tp*apr))
+            omega_clean = omega_clean_uv
+            omega_tp    = omega_tp_uv
+
+        # Generate PSF images
+        # ===================
+
         dd = ''.join(re.findall('[0-9]',str(datetime.datetime.now())))
         baseTP   = 'tmp_msTP'                       # base name of TP images
         baseINT  = 'tmp_msINT'                      # base name of INT images
         dirname  = 'tmp_tp2viswt_' + dd             # temp directory for PSFs
 
-        if makepsf:
+        if makepsf and psfmode in ['tclean','check']:
             os.makedirs(dirname)                    # create scratchdir
 
             angmin  = 999.0                         # derive smallest angle
@@ -1452,21 +2772,29 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
         # Calculate BETA - the ratio of INT and TP weights
         # ================================================
 
-        # Calculate Omega_clean
-        # ---------------------
+        if psfmode in ['tclean','check']:
 
-        beam_int    = imhead(dirname+'/'+baseINT+'.psf')['restoringbeam']
-        bmaj_int    = qa.convert(beam_int['major'],'rad')['value'] # radian
-        bmin_int    = qa.convert(beam_int['minor'],'rad')['value'] # radian
-        omega_clean = np.pi/(4*np.log(2.0)) * bmaj_int*bmin_int
+            # Calculate Omega_clean
+            # ---------------------
 
-        # Calculate Omega_TP [= W_TP(0,0)]
-        # --------------------------------
+            beam_int    = imhead(dirname+'/'+baseINT+'.psf')['restoringbeam']
+            bmaj_int    = qa.convert(beam_int['major'],'rad')['value'] # radian
+            bmin_int    = qa.convert(beam_int['minor'],'rad')['value'] # radian
+            omega_clean = np.pi/(4*np.log(2.0)) * bmaj_int*bmin_int
 
-        beam_tp     = imhead(dirname+'/'+baseTP+'.psf')['restoringbeam']
-        bmaj_tp     = qa.convert(beam_tp['major'],'rad')['value'] # radian
-        bmin_tp     = qa.convert(beam_tp['minor'],'rad')['value'] # radian
-        omega_tp    = np.pi/(4*np.log(2.0)) * bmaj_tp *bmin_tp
+            # Calculate Omega_TP [= W_TP(0,0)]
+            # --------------------------------
+
+            beam_tp     = imhead(dirname+'/'+baseTP+'.psf')['restoringbeam']
+            bmaj_tp     = qa.convert(beam_tp['major'],'rad')['value'] # radian
+            bmin_tp     = qa.convert(beam_tp['minor'],'rad')['value'] # radian
+            omega_tp    = np.pi/(4*np.log(2.0)) * bmaj_tp *bmin_tp
+
+        if psfmode == 'check':
+            print("Omega_clean [strad] uv/tclean = %g / %g = %g" %
+                  (omega_clean_uv,omega_clean,omega_clean_uv/omega_clean))
+            print("Omega_TP    [strad] uv/tclean = %g / %g = %g" %
+                  (omega_tp_uv,omega_tp,omega_tp_uv/omega_tp))
 
         # Derive beta
         #   omega_syn  = omega_TP  = beta/(1+beta)*W_TP(0,0)
@@ -1493,23 +2821,22 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
             ms.selectinit(reset=True)               # all spws
             spwinfo   = ms.getspectralwindowinfo()  # get spw info
             spwlist   = list(spwinfo.keys())        # list of SPWs
+            ms.close()                              # close MS
             iarray    = guessarray(ims)             # array name [e.g. ALMA12]
             fwhm0 = t2v_arrays[iarray]['fwhm100']   # beam FHWM @100GHz[arcsec]
             for ispw in spwlist:                    # loop over SPWs
-                spwid     = spwinfo[ispw]['SpectralWindowId']  # spw #
-                ms.selectinit(reset=True)                      # new since 5.3.0-97
-                ms.selectinit(datadescid=spwid)                # this SPW alone
+                spwid     = spwinfo[ispw]['SpectralWindowId']  # spw # (=ddid)
+                if spwid not in old[ims]:
+                    continue
+                (nw,wmean,wm2,wmin,wmax,fids) = old[ims][spwid] # from "Old:"
                 c1freq = spwinfo[ispw]['Chan1Freq'] / 1.0e9    # 1st chan  [GHz]
                 cwidth = spwinfo[ispw]['ChanWidth'] / 1.0e9    # chanwidth [GHz]
                 fwhm   = fwhm0*(100.0/c1freq)/60.0             # FWHM [arcmin]
                 barea  = np.pi*(fwhm/2.0)**2                   # bm area [amin2]
-                npnt   = len(np.unique(ms.getdata('field_id')['field_id']))
-                weight = ms.getdata('weight')['weight']        # (npol,nvis)
-                weight = weight.sum()/npnt/barea/np.abs(cwidth)# /pnt/amin2/GHz
+                npnt   = len(fids)
+                weight = nw*wmean/npnt/barea/np.abs(cwidth)    # /pnt/amin2/GHz
                 sumw   = sumw + weight              # add
-            ms.close()                              # close MS
     
-        del weight
         print("INT sumw [/GHz/pnt/arcmin2]   = ",sumw)
 
         # Number of TP visibilities [/pnt]
@@ -1517,18 +2844,10 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
 
         nvis = 0
         for ims in msTP:
-            ms.open(ims)
-            ms.selectinit(reset=True)               # all spws
-            for ispw in spwlist:                    # loop over SPWs
-                spwid  = spwinfo[ispw]['SpectralWindowId']     # spw id
-                ms.selectinit(reset=True)           # new since 5.3.0-97                
-                ms.selectinit(datadescid=spwid)     # this SPW alone
-                npnt   = len(np.unique(ms.getdata('field_id')['field_id']))
-                weight = ms.getdata('weight')['weight']        # (npol,nvis)
-                nvis   = nvis + weight.size/npnt    # num of vis
-            ms.close()                              # close MS
+            for spwid in old[ims]:                  # loop over SPWs (=ddid)
+                (nw,wmean,wm2,wmin,wmax,fids) = old[ims][spwid]
+                nvis   = nvis + nw/len(fids)        # num of vis
 
-        del weight
         print("Num of TP vis [per pointing]  = ",nvis)
 
         # Calcuate weight [/GHz/pointing/arcmin2]
@@ -1541,28 +2860,39 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
         # ------------------------------------------
 
         for ims in msTP:
-            ms.open(ims,nomodify=False)             # open MS
+            ms.open(ims,nomodify=True)              # open MS
             ms.selectinit(reset=True)               # all spws
             spwinfo = ms.getspectralwindowinfo()    # get spw info
             spwlist = list(spwinfo.keys())          # list of SPWs
+            ms.close()                              # close MS
             iarray  = guessarray(ims)               # array name [e.g. ALMA12]
             fwhm0   = t2v_arrays[iarray]['fwhm100'] # beam FHWM @100GHz [arcsec]
+            wspw    = {}                            # new weight per spw
             for ispw in spwlist:                    # loop over SPWs
-                spwid     = spwinfo[ispw]['SpectralWindowId']  # spw #
-                ms.selectinit(reset=True)                      # new since 5.3.0-97                
-                ms.selectinit(datadescid=spwid)                # this SPW alone
+                spwid  = spwinfo[ispw]['SpectralWindowId']     # spw # (=ddid)
                 c1freq = spwinfo[ispw]['Chan1Freq'] / 1.0e9    # 1st chan  [GHz]
                 cwidth = spwinfo[ispw]['ChanWidth'] / 1.0e9    # chanwidth [GHz]
                 fwhm   = fwhm0*(100.0/c1freq)/60.0             # FWHM [arcmin]
                 barea  = np.pi*(fwhm/2.0)**2                   # bm area [amin2]
-                record = ms.getdata(['weight','sigma'])        # get records
-                record['weight'][:,:]=w*barea*np.abs(cwidth)   # set new weight
-                record['sigma'][:,:]=1.0/np.sqrt(record['weight'][:,:]) # sigma
-                ms.putdata(record)                  # put them back
-            ms.close()                              # close MS
-
-        wtstat(mslist,comment="New:")               # stat after operation
-        shutil.rmtree(dirname)                      # remove scratchdir
+                wspw[spwid] = w*barea*np.abs(cwidth)           # new weight
+            unknown = [d for d in old[ims] if d not in wspw] # ddids in the rows
+            if unknown != []:
+                raise Exception("TP2VISWT ERROR: DATA_DESC_ID %s of %s not in its spw info" %
+                                (sorted(unknown),ims))
+            wlut    = np.zeros(max(wspw.keys())+1)  # ddid -> weight
+            for spwid in wspw:
+                wlut[spwid] = wspw[spwid]
+
+            def wtspw(weight, ddid):
+                weight[:,:] = wlut[ddid][None,:]
+                return weight
+
+            new[ims] = {}
+            wtupdate(ims,wtspw,acc=new[ims])        # set WEIGHT and SIGMA
+
+        wtstat(mslist,comment="New:",accs=new)      # stat after operation
+        if os.path.isdir(dirname):
+            shutil.rmtree(dirname)                  # remove scratchdir
         return
 
     else:
@@ -1576,7 +2906,7 @@ def tp2viswt(mslist, value=1.0, mode='statistics', makepsf=True):
 ## TP2VISTWEAK: Adjust beam size after (t)clean
 ## ============================================
 
-def tp2vistweak(dirtyname, cleanname, pbcut=0.8, mask=''):
+def tp2vistweak(dirtyname, cleanname, pbcut=0.8, mask='', method='immath'):
     """
     Mismatch of dirty and clean/restore beam areas become noticable in
     TP+INT joint-deconvolution. This function compares the two beam areas,
@@ -1590,6 +2920,10 @@ def tp2vistweak(dirtyname, cleanname, pbcut=0.8, mask=''):
     pbcut       cutoff level of .pb map to define area for flux integration
                 @todo clean() was using minpb=,   tclean() now uses pblimit=
     mask        user specified mask
+    method      'immath'  use immath/imstat on scratch images (default)
+                'numpy'   stream the dirty, clean, residual and pb planes, in
+                          one pass for the sums and one to write the new images,
+                          without scratch images
     dirty and clean images must have the same shape, and it is assumed that
     your version of tclean() has also create the corresponding .residual and
     .pb images.
@@ -1632,10 +2966,57 @@ def tp2vistweak(dirtyname, cleanname, pbcut=0.8, mask=''):
         print("TP2VISTWEAK ERROR: need the above files")
         return
 
-    for f in [newclean,newresid]:               # if output files
+    for f in [newclean,newresid,newpbcor]:      # if output files
         if os.path.exists(f):                   #   already exist,
             shutil.rmtree(f)                    #   remove them
     
+    # Put missing header key in residual
+    imhead(resid,mode='put',hdkey='bunit',hdvalue='Jy/beam')
+
+    if method == 'numpy':
+        (bmaj_dirty,bmin_dirty,bmaj_clean,bmin_clean,sum_dirty,sum_clean,omegarat) = \
+            tweakplanes(dirty,clean,resid,pbmap,newclean,newresid,newpbcor,pbcut,mask)
+    else:
+        (bmaj_dirty,bmin_dirty,bmaj_clean,bmin_clean,sum_dirty,sum_clean,omegarat) = \
+            tweakimmath(dirty,clean,resid,pbmap,newclean,newresid,newpbcor,pbcut,mask)
+
+    # Print
+    # -----
+
+    print("\nTP2VISTWEAK: 'ImageExprCalculator::compute+' warning is harmless - ignore.")
+    print("Stat: %8s %8s %10s %10s %10s" % \
+        ("Bmaj","Bmin","Sum(dirty)","Sum(clean)", "dirty/clean"))
+    print("      %8.3f %8.3f %10.4f %10.4f %10.4f" % \
+        (bmaj_clean,bmin_clean,sum_dirty,sum_clean,omegarat))
+    print("      %8.3f %8.3f" % \
+        (bmaj_dirty,bmin_dirty))
+
+    print("Scale residual image %s - multiply %f" % (resid,omegarat))
+    print("     New residual image: %s" % (newresid))
+    print("Re-compute cleaned image")
+    print("     New clean image: %s" % (newclean))
+
+    return
+
+    #-end of tp2vistweak()
+
+def tweakbeam(h0):
+    """ return (bmaj,bmin) of the (first plane) beam in the imhead() h0
+            Helper function for tp2vistweak()
+    """
+    if 'perplanebeams' in h0:
+        beam = h0['perplanebeams']['beams']['*0']['*0']
+    else:
+        beam = h0['restoringbeam']
+    return (beam['major']['value'],beam['minor']['value'])
+
+def tweakimmath(dirty, clean, resid, pbmap, newclean, newresid, newpbcor, pbcut, mask):
+    """ the immath/imstat implementation of tp2vistweak(), with scratch
+    images in a temporary directory
+    Returns (bmaj_dirty,bmin_dirty,bmaj_clean,bmin_clean,sum_dirty,sum_clean,omegarat)
+            Helper function for tp2vistweak()
+    """
+
     # Temporary files
     dd = ''.join(re.findall('[0-9]',str(datetime.datetime.now())))
     dirname = 'tmp_tp2vistweak_' + dd           # temp directory for PSFs  
@@ -1644,10 +3025,6 @@ def tp2vistweak(dirtyname, cleanname, pbcut=0.8, mask=''):
     diff_dirty = dirname + '/image_diff_dirty.im' 
     diff_clean = dirname + '/image_diff_clean.im' 
 
-    # Put missing header key in residual
-    imhead(resid,mode='put',hdkey='bunit',hdvalue='Jy/beam')
-
-
     # Subtract residual from dirty and clean
     # --------------------------------------
     immath(imagename=[dirty,resid],expr='IM0-IM1',outfile=diff_dirty)
@@ -1665,18 +3042,9 @@ def tp2vistweak(dirtyname, cleanname, pbcut=0.8, mask=''):
     dx_clean,dy_clean,dummy,dummy = imhead(diff_clean)['incr'] * apr
 
     # Beam size
-    h0 = imhead(diff_dirty)
-    if 'perplanebeams' in h0:
-        bmaj_dirty=imhead(diff_dirty)['perplanebeams']['beams']['*0']['*0']['major']['value']
-        bmin_dirty=imhead(diff_dirty)['perplanebeams']['beams']['*0']['*0']['minor']['value']
-        bmaj_clean=imhead(diff_clean)['perplanebeams']['beams']['*0']['*0']['major']['value']
-        bmin_clean=imhead(diff_clean)['perplanebeams']['beams']['*0']['*0']['minor']['value']
-    else:
-        bmaj_dirty=imhead(diff_dirty)['restoringbeam']['major']['value']
-        bmin_dirty=imhead(diff_dirty)['restoringbeam']['minor']['value']
-        bmaj_clean=imhead(diff_clean)['restoringbeam']['major']['value']
-        bmin_clean=imhead(diff_clean)['restoringbeam']['minor']['value']
-        
+    (bmaj_dirty,bmin_dirty) = tweakbeam(imhead(diff_dirty))
+    (bmaj_clean,bmin_clean) = tweakbeam(imhead(diff_clean))
+
 
     # Sum over high PB area 
     maskarea  = '\'' + pbmap + '\'' + '>' + str(pbcut)           # CASA LEL friendly
@@ -1708,43 +3076,162 @@ def tp2vistweak(dirtyname, cleanname, pbcut=0.8, mask=''):
     imhead(newclean,mode='put',hdkey='bunit',hdvalue='Jy/beam')
     imhead(newpbcor,mode='put',hdkey='bunit',hdvalue='Jy/beam')    
 
-    # Print
-    # -----
+    return (bmaj_dirty,bmin_dirty,bmaj_clean,bmin_clean,sum_dirty,sum_clean,omegarat)
 
-    print("\nTP2VISTWEAK: 'ImageExprCalculator::compute+' warning is harmless - ignore.")
-    print("Stat: %8s %8s %10s %10s %10s" % \
-        ("Bmaj","Bmin","Sum(dirty)","Sum(clean)", "dirty/clean"))
-    print("      %8.3f %8.3f %10.4f %10.4f %10.4f" % \
-        (bmaj_clean,bmin_clean,sum_dirty,sum_clean,omegarat))
-    print("      %8.3f %8.3f" % \
-        (bmaj_dirty,bmin_dirty))
+def imlike(outfile, template, masks=[], order='0123'):
+    """ create outfile with the shape, coordinates, beam(s) and unit of
+    template, and a pixel mask that is the AND of the masks of the
+    images in masks (as immath would give); returns the open image tool.
+    With an axorder() order the axes of outfile are transposed by it.
+            Helper function for tweakplanes() and tp2vis()
+    """
+    t0    = iatool()
+    t0.open(template)
+    shape = t0.shape()
+    csys  = t0.coordsys()
+    bunit = t0.brightnessunit()
+    beam  = t0.restoringbeam()
+    t0.close()
+    if order != '0123':
+        perm  = [int(c) for c in order]
+        shape = [shape[p] for p in perm]
+        csys.transpose(perm)
+    t     = iatool()
+    t.fromshape(outfile,shape=shape,csys=csys.torecord(),overwrite=True)
+    csys.done()
+    if order == '0123':
+        t.setrestoringbeam(imagename=template)  # copy the beam(s)
+    elif 'major' in beam:
+        t.setrestoringbeam(beam=beam)           # the single beam
+    t.setbrightnessunit(bunit)
+    if masks != []:
+        t.calcmask(' && '.join(["mask('%s')" % m for m in masks]),name='mask0')
+    return t
+
+def tweakplanes(dirty, clean, resid, pbmap, newclean, newresid, newpbcor, pbcut, mask):
+    """ the numpy implementation of tp2vistweak(), without scratch images.
+    The planes of the dirty, clean, residual and pb cubes are read once to
+    sum (dirty-resid) and (clean-resid) where pb > pbcut (and the user mask),
+    and the clean, residual and pb planes once more to write the new residual,
+    clean and pbcor images. Pixel masks are combined as immath/imstat do.
+    Returns (bmaj_dirty,bmin_dirty,bmaj_clean,bmin_clean,sum_dirty,sum_clean,omegarat)
+            Helper function for tp2vistweak()
+    """
+    apr = qa.convert('1.0rad','arcsec')['value'] # arcsec per radian
+    cbm = np.pi/(4.0*np.log(2.0))                # beamarea=cbm*bmaj*bmin
 
-    print("Scale residual image %s - multiply %f" % (resid,omegarat))
-    print("     New residual image: %s" % (newresid))
-    print("Re-compute cleaned image")
-    print("     New clean image: %s" % (newclean))
+    # Pixel and beam size (diff images have the header of dirty and clean)
+    h_dirty = imhead(dirty)
+    h_clean = imhead(clean)
+    dx_dirty,dy_dirty = h_dirty['incr'][0:2] * apr
+    dx_clean,dy_clean = h_clean['incr'][0:2] * apr
+    (bmaj_dirty,bmin_dirty) = tweakbeam(h_dirty)
+    (bmaj_clean,bmin_clean) = tweakbeam(h_clean)
+
+    # Open the four cubes (and the user mask expression)
+    names  = [dirty,clean,resid,pbmap]
+    tools  = []
+    for name in names:
+        t = iatool()
+        t.open(name)
+        tools.append(t)
+    hasmask = [t.maskhandler('default')[0] != '' for t in tools]
+    if mask != '':
+        tools.append(ia.imagecalc(pixels='iif(%s,1.0,0.0)' % mask))
+    shape  = tools[0].shape()
+    ndim   = len(shape)
+
+    def plane(t, iz, getmask=False):
+        return t.getchunk([0]*(ndim-1)+[iz],[-1]*(ndim-1)+[iz],getmask=getmask)
+
+    # Sum over high PB area, one pass over the planes
+    sum_dirty = 0.0
+    sum_clean = 0.0
+    for iz in range(shape[-1]):
+        (d,c,r,pb) = [plane(t,iz) for t in tools[0:4]]
+        (md,mc,mr,mpb) = [plane(t,iz,True) for t in tools[0:4]]
+        m = mr & mpb & (pb > pbcut)
+        if mask != '':
+            m = m & plane(tools[4],iz,True) & (plane(tools[4],iz) > 0.5)
+        sum_dirty = sum_dirty + np.sum((d-r)[m & md],dtype=np.float64)
+        sum_clean = sum_clean + np.sum((c-r)[m & mc],dtype=np.float64)
+    sum_dirty = sum_dirty * np.abs(dx_dirty*dy_dirty) / (cbm*bmaj_dirty*bmin_dirty)
+    sum_clean = sum_clean * np.abs(dx_clean*dy_clean) / (cbm*bmaj_clean*bmin_clean)
 
-    return
+    # Calculate beam ratio
+    #    Omega_dirty/Omega_clean = sum_clean/sum_dirty
+    # ------------------------------------------------
+    omegarat = sum_clean/sum_dirty
+
+    # Scale residual image and re-calculate cleaned image, second pass
+    # ----------------------------------------------------------------
+    masked = [n for (n,h) in zip(names,hasmask) if h]
+    m_res  = [n for n in masked if n == resid]
+    m_cln  = [n for n in masked if n in [clean,resid]]
+    m_pbc  = [n for n in masked if n in [clean,resid,pbmap]]
+    outs   = [imlike(newresid,resid,m_res),
+              imlike(newclean,clean,m_cln),
+              imlike(newpbcor,clean,m_pbc)]
+    for iz in range(shape[-1]):
+        (c,r,pb) = [plane(t,iz) for t in tools[1:4]]
+        nresid = r * omegarat
+        nclean = (c - r) + nresid
+        with np.errstate(divide='ignore',invalid='ignore'):
+            npbcor = nclean / pb
+        blc    = [0]*(ndim-1)+[iz]
+        for (t,p) in zip(outs,[nresid,nclean,npbcor]):
+            t.putchunk(p,blc=blc)
+    for t in outs + tools:
+        t.done()
+
+    # Put missing header key in new maps
+    imhead(newresid,mode='put',hdkey='bunit',hdvalue='Jy/beam')
+    imhead(newclean,mode='put',hdkey='bunit',hdvalue='Jy/beam')
+    imhead(newpbcor,mode='put',hdkey='bunit',hdvalue='Jy/beam')    
+
+    return (bmaj_dirty,bmin_dirty,bmaj_clean,bmin_clean,sum_dirty,sum_clean,omegarat)
 
-    #-end of tp2vistweak()
 
 ## =================================
 ## TP2VISPL: Plot visibility weights
 ## =================================
 
-def tp2vispl(mslist, ampPlot=True, uvmax = 150.0, uvzoom=50.0, uvbin=0.5, show=False, outfig='plot_tp2viswt.png'):
+def densityhist(x, y, ext, nbin=256):
+    """ return the 2D histogram hist[ix][iy] of (x,y) in ext=[x0,x1,y0,y1]
+            Helper function for tp2vispl()
+    """
+    hist,xe,ye = np.histogram2d(x,y,bins=nbin,range=[ext[0:2],ext[2:4]])
+    return hist
+
+def densityshow(ax, hist, ext, color):
+    """ show a densityhist() in a single color, the opacity scaling
+    with log(1+counts), so that histograms of several arrays overlay
+            Helper function for tp2vispl()
+    """
+    import matplotlib.colors as mcolors
+    rgba = np.zeros((hist.shape[1],hist.shape[0],4))
+    rgba[:,:,0:3] = mcolors.to_rgb(color)
+    if hist.max() > 0:
+        rgba[:,:,3] = (np.log1p(hist)/np.log1p(hist.max())).T
+    ax.imshow(rgba,origin='lower',extent=ext,aspect='auto',interpolation='nearest')
+
+def tp2vispl(mslist, ampPlot=True, uvmax = 150.0, uvzoom=50.0, uvbin=0.5, show=False, outfig='plot_tp2viswt.png',
+             density=True, nbin=256):
     """
     Plotting TP, 7m, and 12m MSs
     MS should have been mstransform'd to the same freq range
     Parameters:
     -----------
     # need at least msTP
-    mslist    list of measurement sets to plot
+    mslist    list of measurement sets to plot, or tp2visexport() stores
     ampPlot   True     amp-uvdistance plot
               False    weight-uvdistance plot
     show      True     plot in display as well as in file
               False    not plot in display, but in file
     outfig    file name of output figure
+    density   True     plot the visibilities as 2D histograms (fast for large MSs)
+              False    scatter plot every visibility
+    nbin      number of bins per axis of the 2D histograms
     """
 
     print("TP2VISPL: Plot MSs - ignores flags")
@@ -1787,18 +3274,11 @@ def tp2vispl(mslist, ampPlot=True, uvmax = 150.0, uvzoom=50.0, uvbin=0.5, show=F
         msfile = msTP[0]                        # use it as freq reference
     else:                                       # otherwise
         msfile = mslist[0]                      # use the first
-    ms.open(msfile)                             # open MS
-    ms.selectinit(reset=True)                   # all SPWs
-
     print("Pick up max flux channel in %s" % (msfile))
-    cfreq  = ms.getdata('axis_info')['axis_info']['freq_axis']['chan_freq']
-                                                # (freq,spw)
-    cfreq  = np.transpose(cfreq[:,0]) / 1.0e9   # pick first spw
-    asum   = ms.getdata('amplitude')['amplitude'] # (pol,freq,vis)
-    asum   = asum.sum(axis=2).sum(axis=0)       # sum over vis & pol
+    (cfreq,asum) = ampspectrum(msfile)          # first spw, sum over vis & pol
+    cfreq  = cfreq / 1.0e9                      # [GHz]
     maxc   = np.argmax(asum)                    # max flux channel
     targetfreq = cfreq[maxc]                    # target freq for plot
-    ms.close()
 
     print("   (chan,freq) = (%d, %f GHz)" % (maxc,targetfreq))
 
@@ -1825,11 +3305,15 @@ def tp2vispl(mslist, ampPlot=True, uvmax = 150.0, uvzoom=50.0, uvbin=0.5, show=F
         iarray = guessarray(msfile)             # array name
         fwhm0  = t2v_arrays[iarray]['fwhm100']  # FHWM at 100GHz [arcsec]
 
-        ms.open(msfile,nomodify=True)           # open MS
+        store  = isvisstore(msfile)             # tp2visexport() store?
+        if store:
+            spwinfo  = storespw(msfile)[1]      # spw info
+        else:
+            ms.open(msfile,nomodify=True)       # open MS
 
-        # Find SPWs that include targetfreq
-        ms.selectinit(reset=True)               # all spws
-        spwinfo  = ms.getspectralwindowinfo()   # spw info
+            # Find SPWs that include targetfreq
+            ms.selectinit(reset=True)           # all spws
+            spwinfo  = ms.getspectralwindowinfo() # spw info
         spwlist  = []
         for ispw in list(spwinfo.keys()):       # loop over SPWs
             nchan  = spwinfo[ispw]['NumChan']   # num of chan
@@ -1843,13 +3327,13 @@ def tp2vispl(mslist, ampPlot=True, uvmax = 150.0, uvzoom=50.0, uvbin=0.5, show=F
             elif ((f0 - targetfreq)*(f1 - targetfreq)<0):# if incl. target freq
                 spwlist.append(ispw)            # append it
 
-        # Read data
+        # Read data, per SPW, concatenated once after the loop
         # ---------
-        fid = np.array([])                      # field id
-        uu  = np.array([])                      # uu
-        vv  = np.array([])                      # vv
-        wt  = np.array([])                      # weight
-        amp = np.array([])                      # amplitude
+        fid = []                                # field id
+        uu  = []                                # uu
+        vv  = []                                # vv
+        wt  = []                                # weight
+        amp = []                                # amplitude
 
         # Loop over SPWs
         # --------------
@@ -1866,41 +3350,60 @@ def tp2vispl(mslist, ampPlot=True, uvmax = 150.0, uvzoom=50.0, uvbin=0.5, show=F
             ichan  = np.argmin(np.abs(cfreq - targetfreq)) # closest to target
 
             # Limit data to load
-            ms.selectinit(reset=True)                  # needed since casa 5.3.0-97
-            if not ms.selectinit(datadescid=spwid):    # this SPW only
-                print("MS.SELECTINIT bad selection for spwid=%d - CASA bug?" % spwid)
-                continue
-            if not ms.select({'uvdist':[0.0,uvMax]}):  # limit uv range
-                print("MS.SELECT nothing returned for spwid=%d - CASA bug?" % spwid)
-                continue
-
-            # Read parameters [note: wt(pol,vis)]
-            fid    = np.append(fid,ms.getdata('field_id')['field_id'])
-            uu     = np.append(uu,ms.getdata('u')['u'],axis=0)  # meter
-            vv     = np.append(vv,ms.getdata('v')['v'],axis=0)  # meter
-            npnt   = len(np.unique(ms.getdata('field_id')['field_id']))
-            wtemp  = ms.getdata('weight')['weight'].sum(axis=0) # sum pol
+            if store:                                  # rows within uvMax, and channel
+                rec    = storeread(msfile,spwid,uvMax,ichan if ampPlot else None)
+                if len(rec['u']) == 0:
+                    print("STOREREAD nothing returned for spwid=%d" % spwid)
+                    continue
+            else:
+                ms.selectinit(reset=True)              # needed since casa 5.3.0-97
+                if not ms.selectinit(datadescid=spwid):# this SPW only
+                    print("MS.SELECTINIT bad selection for spwid=%d - CASA bug?" % spwid)
+                    continue
+                if not ms.select({'uvdist':[0.0,uvMax]}): # limit uv range
+                    print("MS.SELECT nothing returned for spwid=%d - CASA bug?" % spwid)
+                    continue
+
+                # Read parameters [note: wt(pol,vis)]
+                rec    = ms.getdata(['field_id','u','v','weight'])
+            fid.append(rec['field_id'])
+            uu.append(rec['u'])                                 # meter
+            vv.append(rec['v'])                                 # meter
+            npnt   = len(np.unique(rec['field_id']))
+            wtemp  = rec['weight'].sum(axis=0)                  # sum pol
             wtemp  = wtemp/npnt/barea/np.abs(cwidth)            # /pnt/amin2/GHz
-
-            # Append
-            wt = np.append(wt, wtemp,axis=0)
+            wt.append(wtemp)
+            del wtemp
 
             # Amplitude
             if ampPlot:                         # if plot amp
-                ms.selectchannel(1,ichan,1,1)   # nchan,start,width,inc
-                amp0  = ms.getdata('amplitude')['amplitude'].mean(axis=(0,1))
+                if store:
+                    amp0  = rec['amplitude']    # ave for pol
+                else:
+                    ms.selectchannel(1,ichan,1,1) # nchan,start,width,inc
+                    amp0  = ms.getdata('amplitude')['amplitude'].mean(axis=(0,1))
                                                 # ave for pol, spw
-                amp   = np.append(amp,amp0)     # append
+                amp.append(amp0)
                 if iarray == 'VIRTUAL':         # store max for TP
                     ampTPMax = np.amax([ampTPMax,np.amax(amp0)])
-
-            del wtemp, amp0
+                del amp0
 
             # print
             print("%30s: (spw,chan,freq,fwid) = (%3d, %5d, %10.6f, %10.6f)" \
                 % (msfile,spwid,ichan,cfreq[ichan],cwidth))
 
-        ms.close()                              # Close MS
+            del rec
+
+        if not store:
+            ms.close()                          # Close MS
+
+        if wt == []:
+            continue
+        fid = np.concatenate(fid)
+        uu  = np.concatenate(uu)
+        vv  = np.concatenate(vv)
+        wt  = np.concatenate(wt)
+        if ampPlot: amp = np.concatenate(amp)
 
         # Remove data with zero weights and calc params
         # ---------------------------------------------
@@ -1918,10 +3421,11 @@ def tp2vispl(mslist, ampPlot=True, uvmax = 150.0, uvzoom=50.0, uvbin=0.5, show=F
         # Calculate averages in bins
         # --------------------------
 
-        uvbins   = np.arange(0.0,uvdist.max() + bin, bin)
-        digit    = np.digitize(uvdist,uvbins)
+        nuvbin   = int(uvdist.max()/bin) + 1    # num of radial bins
+        uvbins   = np.arange(nuvbin+1)*bin      # bin edges
+        digit    = (uvdist/bin).astype(int)     # bin of each vis
         uvarea   = np.pi*np.diff(uvbins*uvbins)
-        wtbins   = [wt[digit==i].sum() for i in range(1,len(uvbins))]
+        wtbins   = np.bincount(digit,weights=wt,minlength=nuvbin)
         wtbins   = wtbins/uvarea
         uvbins   = uvbins[1:]
         wtbins   = wtbins/nfid                  # per pointing
@@ -1931,15 +3435,32 @@ def tp2vispl(mslist, ampPlot=True, uvmax = 150.0, uvzoom=50.0, uvbin=0.5, show=F
         # Plot
         # ----
 
-        # Top-left: uu vs vv
-        axtl.scatter( uu, vv,marker='.',s=0.2,c=color,lw=0)
-        axtl.scatter(-uu,-vv,marker='.',s=0.2,c=color,lw=0)
-
-        # Top-right: uvdist vs amplitude or weight [Zoom-up]
         if ampPlot:
-            axtr.scatter(uvdist,amp,marker='.',s=0.2,c=color,lw=0)
+            yy = amp
         else:
-            axtr.scatter(uvdist,wt,marker='.',s=0.2,c=color,lw=0)
+            yy = wt
+
+        if density:
+            # Top-left: uu vs vv, (u,v) and (-u,-v) [symmetric bins]
+            uvext = [-uvZoom,uvZoom,-uvZoom,uvZoom]
+            hist  = densityhist(uu,vv,uvext,nbin)
+            densityshow(axtl,hist+hist[::-1,::-1],uvext,color)
+
+            # Top-right: uvdist vs amplitude or weight [Zoom-up]
+            idx   = uvdist < uvZoom
+            if idx.any():
+                ymin,ymax = yy[idx].min(),yy[idx].max()
+                if ymax <= ymin: ymax = ymin + 1.0
+                ext   = [0.0,uvZoom,ymin,ymax]
+                densityshow(axtr,densityhist(uvdist,yy,ext,nbin),ext,color)
+            del idx
+        else:
+            # Top-left: uu vs vv
+            axtl.scatter( uu, vv,marker='.',s=0.2,c=color,lw=0)
+            axtl.scatter(-uu,-vv,marker='.',s=0.2,c=color,lw=0)
+
+            # Top-right: uvdist vs amplitude or weight [Zoom-up]
+            axtr.scatter(uvdist,yy,marker='.',s=0.2,c=color,lw=0)
 
         # Bottom-right: uvdist vs wtdens [zoom-up]
         axbr.plot(uvbins,wtbins,c=color,drawstyle='steps-mid')
@@ -1949,7 +3470,7 @@ def tp2vispl(mslist, ampPlot=True, uvmax = 150.0, uvzoom=50.0, uvbin=0.5, show=F
 
         wtbins = wtbins[wtbins>0]
         print("weight min/max ",wtbins.min(),wtbins.max())
-        del uu,vv,uvdist,wt,uvbins,wtbins
+        del uu,vv,yy,uvdist,wt,uvbins,wtbins
 
     # Plot frames, scales, etc
     # ------------------------